@@ -1,15 +1,23 @@
 import sys
 import os
-from collections import defaultdict
-from PyQt6.QtCore import QTimer, Qt
+import argparse
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from Cache import ResultCache
+import Profile
+from PyQt6.QtCore import QThread, QTimer, Qt, pyqtSignal
 from PyQt6.QtGui import QFont
 from PyQt6.QtWidgets import *
-from Experiment import RWArgs, create_group_and_phase, run_group_experiments, group_results, Phase
-from Plots import show_plots, generate_figures
+from Experiment import RWArgs, Phase, GroupRun, group_results, simulation_args, update_group_run
 from Strengths import History
 
+import matplotlib
+matplotlib.use('QtAgg')
+
 from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg
 from matplotlib import pyplot
+from Plots import show_plots, generate_figures
 
 class CoolTable(QTableWidget):
     def __init__(self, rows: int, cols: int):
@@ -119,8 +127,179 @@ class CoolTable(QTableWidget):
 
         self.freeze = False
 
+# Raised inside a job that has been superseded by a newer one.
+class Cancelled(Exception):
+    pass
+
+# SimulationWorker runs the simulations in the background, one job at a time.
+# Requesting a new job while one is running cancels the running one, so that only the latest
+# request is completed; its results are sent through `done`.
+# The worker owns the runs of every group and the process pool, which are kept between jobs.
+class SimulationWorker(QThread):
+    progress = pyqtSignal(int, str)
+    done = pyqtSignal(int, object)
+    failed = pyqtSignal(int, str)
+
+    def __init__(self, cache : None | ResultCache, parent = None):
+        super().__init__(parent)
+
+        self.cache = cache
+        self.runs = {}
+
+        # Pool of processes used to run the groups in parallel.
+        self.executor = None
+        self.executorJobs = 1
+
+        self.condition = threading.Condition()
+        self.job = None
+        self.stopping = False
+
+    # request replaces any job that hasn't started yet, and cancels the running one.
+    def request(self, jobId : int, groups : list[tuple[str, list[str]]], args : RWArgs, columnCount : int, jobs : int, profile : bool = False):
+        with self.condition:
+            self.job = (jobId, groups, args, columnCount, jobs, profile)
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+
+        self.wait()
+        if self.executor is not None:
+            self.executor.shutdown(wait = False, cancel_futures = True)
+
+    def checkCancelled(self):
+        if self.job is not None or self.stopping:
+            raise Cancelled()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.job is None and not self.stopping:
+                    self.condition.wait()
+
+                if self.stopping:
+                    return
+
+                jobId, groups, args, columnCount, jobs, profile = self.job
+                self.job = None
+
+            # Profiles of other processes would be lost, so profiled jobs run in this one.
+            if profile:
+                Profile.start()
+                jobs = 1
+
+            try:
+                strengths, phases = self.simulate(jobId, groups, args, columnCount, jobs)
+            except Cancelled:
+                continue
+            except Exception as e:
+                self.failed.emit(jobId, f'{type(e).__name__}: {e}')
+                continue
+            finally:
+                profiler = Profile.stop()
+
+            if profiler is not None:
+                print(profiler.summary())
+
+            self.done.emit(jobId, (strengths, phases, args))
+
+    def getExecutor(self, jobs : int) -> None | ProcessPoolExecutor:
+        if jobs != self.executorJobs and self.executor is not None:
+            self.executor.shutdown(cancel_futures = True)
+            self.executor = None
+
+        self.executorJobs = jobs
+        if jobs > 1 and self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers = jobs)
+
+        return self.executor
+
+    def simulate(self, jobId : int, groups : list[tuple[str, list[str]]], args : RWArgs, columnCount : int, jobs : int) -> tuple[dict[str, History], dict[str, list[Phase]]]:
+        # Groups are only run again from the first phase that changed since the last job, and
+        # not at all if none did.
+        runs = {}
+        pending = []
+        for name, phase_strs in groups:
+            run = self.runs.get(name)
+            if run is None or simulation_args(run.args) != simulation_args(args):
+                run = GroupRun(name, args)
+
+                key = None if self.cache is None else self.cache.key(name, phase_strs, args)
+                cached = None if key is None else self.cache.get(key)
+                if cached is not None:
+                    run.load(phase_strs, *cached)
+
+            runs[name] = run
+
+            if [x.strip() for x in run.phase_strs] != [x.strip() for x in phase_strs]:
+                pending.append((name, phase_strs))
+
+        executor = self.getExecutor(jobs)
+        if executor is None:
+            updated = self.updateSerial(jobId, [runs[name] for name, _ in pending], [phase_strs for _, phase_strs in pending])
+        else:
+            updated = self.updateParallel(jobId, executor, [runs[name] for name, _ in pending], [phase_strs for _, phase_strs in pending])
+
+        for (name, phase_strs), run in zip(pending, updated):
+            runs[name] = run
+
+            key = None if self.cache is None else self.cache.key(name, phase_strs, args)
+            if key is not None:
+                self.cache.put(key, (run.results, run.phases))
+
+        for run in runs.values():
+            run.args = args
+
+        self.runs = runs
+
+        strengths = [History.emptydict() for _ in range(columnCount)]
+        phases = dict()
+        for name, _ in groups:
+            local_strengths = group_results(runs[name].results, name, args, runs[name].phases)
+            strengths = [a | b for a, b in zip(strengths, local_strengths)]
+            phases[name] = runs[name].phases
+
+        return strengths, phases
+
+    # Runs are updated in place, and left unchanged if the job is cancelled half-way through them.
+    def updateSerial(self, jobId : int, runs : list[GroupRun], phase_strss : list[list[str]]) -> list[GroupRun]:
+        last = 0.
+        for e, (run, phase_strs) in enumerate(zip(runs, phase_strss)):
+            def progress(phase_num, done):
+                nonlocal last
+                self.checkCancelled()
+
+                # Updating the status on every replicate would flood the event loop.
+                if time.monotonic() - last > .1:
+                    last = time.monotonic()
+                    total = run.args.num_trials if Phase(phase_strs[phase_num]).rand else 1
+                    self.progress.emit(jobId, f'Group {run.name} ({e + 1}/{len(runs)}): phase {phase_num + 1}/{len(phase_strs)}, replicate {done}/{total}')
+
+            run.update(phase_strs, progress)
+
+        return runs
+
+    # Runs are pickled to the pool, so they are replaced by the updated copies that come back.
+    def updateParallel(self, jobId : int, executor : ProcessPoolExecutor, runs : list[GroupRun], phase_strss : list[list[str]]) -> list[GroupRun]:
+        futures = [executor.submit(update_group_run, run, phase_strs) for run, phase_strs in zip(runs, phase_strss)]
+        waiting = set(futures)
+        try:
+            while waiting:
+                self.checkCancelled()
+                done, waiting = wait(waiting, timeout = .1, return_when = FIRST_COMPLETED)
+                if done:
+                    self.progress.emit(jobId, f'{len(futures) - len(waiting)}/{len(futures)} groups done')
+        except Cancelled:
+            for future in futures:
+                future.cancel()
+            raise
+
+        return [x.result() for x in futures]
+
 class PavlovianApp(QDialog):
-    def __init__(self, parent=None):
+    def __init__(self, cache : None | ResultCache = None, parent=None):
         super(PavlovianApp, self).__init__(parent)
 
         self.adaptive_types = ['linear', 'exponential', 'mack', 'hall', 'macknhall', 'dualV', 'newDualV', 'lepelley', 'dualmack', 'hybrid']
@@ -132,6 +311,19 @@ class PavlovianApp(QDialog):
         self.phase = 1
         self.numPhases = 0
         self.figures = []
+
+        # Results of groups that haven't changed are reused between sessions when there's a cache.
+        self.cache = cache
+
+        # Simulations run in the background; only the results of the latest job are shown.
+        self.jobId = 0
+        self.showPlots = False
+        self.worker = SimulationWorker(self.cache)
+        self.worker.progress.connect(self.jobProgress)
+        self.worker.done.connect(self.jobFinished)
+        self.worker.failed.connect(self.jobFailed)
+        self.worker.start()
+
         self.initUI()
 
         QTimer.singleShot(100, self.updateWidgets)
@@ -176,8 +368,11 @@ class PavlovianApp(QDialog):
         self.phaseBoxLayout.addWidget(self.rightPhaseButton, 0, 6, 1, 1)
         self.phaseBox.setLayout(self.phaseBoxLayout)
 
+        self.statusInfo = QLabel('')
+
         self.plotBoxLayout.addWidget(self.plotCanvas, stretch = 1)
         self.plotBoxLayout.addWidget(self.phaseBox)
+        self.plotBoxLayout.addWidget(self.statusInfo)
         self.plotBox.setLayout(self.plotBoxLayout)
 
         mainLayout = QGridLayout()
@@ -210,10 +405,12 @@ class PavlovianApp(QDialog):
 
         self.plotAlphaCheckbox = QCheckBox('Plot α')
         self.plotMnHCheckbox = QCheckBox("Mack'n'Hall")
+        self.plotSECheckbox = QCheckBox('±SE')
         
         self.plotTickBoxesLayout = QHBoxLayout()
         self.plotTickBoxesLayout.addWidget(self.plotAlphaCheckbox)
         self.plotTickBoxesLayout.addWidget(self.plotMnHCheckbox)
+        self.plotTickBoxesLayout.addWidget(self.plotSECheckbox)
         self.plotTickBoxes = QGroupBox('')
         self.plotTickBoxes.setLayout(self.plotTickBoxesLayout)
 
@@ -226,6 +423,9 @@ class PavlovianApp(QDialog):
         self.printButton = QPushButton("Plot")
         self.printButton.clicked.connect(self.plotExperiment)
 
+        # Profiled runs print a summary of where the time went to the terminal.
+        self.profileCheckbox = QCheckBox('Profile')
+
         layout = QVBoxLayout()
         layout.addWidget(self.fileButton)
         layout.addWidget(self.saveButton)
@@ -234,6 +434,7 @@ class PavlovianApp(QDialog):
         layout.addWidget(self.setDefaultParamsButton)
         layout.addWidget(self.refreshButton)
         layout.addWidget(self.printButton)
+        layout.addWidget(self.profileCheckbox)
         layout.addStretch(1)
         self.adaptiveTypeGroupBox.setLayout(layout)
 
@@ -319,6 +520,8 @@ class PavlovianApp(QDialog):
         self.thetaI = DualLabel("θᴵ", params, self, 'Monospace')
         self.window_size = DualLabel("Window Size", params, self)
         self.num_trials = DualLabel("Number Trials", params, self)
+        self.seed = DualLabel("Seed", params, self)
+        self.jobs = DualLabel("Jobs", params, self)
 
         params.setLabelAlignment(Qt.AlignmentFlag.AlignRight)
 
@@ -334,7 +537,8 @@ class PavlovianApp(QDialog):
             'thetaE': '0.3',
             'thetaI': '0.1',
             'window_size': '10',
-            'num_trials': '1000'
+            'num_trials': '1000',
+            'jobs': '1',
         }
 
         for key, value in defaults.items():
@@ -347,13 +551,20 @@ class PavlovianApp(QDialog):
             return None
         return float(text)
 
-    def generateResults(self) -> tuple[dict[str, History], dict[str, list[Phase]], RWArgs]:
+    @staticmethod
+    def intOrNone(text: str) -> None | int:
+        if text == '':
+            return None
+        return int(text)
+
+    # Reads the parameters and the design from the widgets; returns the arguments, the groups and the number of columns in use.
+    def readDesign(self) -> tuple[RWArgs, list[tuple[str, list[str]]], int]:
         self.current_adaptive_type = self.adaptivetypeComboBox.currentText()
 
         args = RWArgs(
             adaptive_type = self.current_adaptive_type,
 
-            alphas = defaultdict(lambda: float(self.alpha.box.text())),
+            alphas = {},
             alpha = float(self.alpha.box.text()),
             alpha_mack = self.floatOrNone(self.alpha_mack.box.text()),
             alpha_hall = self.floatOrNone(self.alpha_hall.box.text()),
@@ -367,9 +578,11 @@ class PavlovianApp(QDialog):
 
             window_size = int(self.window_size.box.text()),
             num_trials = int(self.num_trials.box.text()),
+            seed = self.intOrNone(self.seed.box.text()),
 
             plot_alpha = self.plotAlphaCheckbox.checkState() == Qt.CheckState.Checked,
             plot_macknhall = self.plotMnHCheckbox.checkState() == Qt.CheckState.Checked,
+            plot_se = self.plotSECheckbox.checkState() == Qt.CheckState.Checked,
 
             use_configurals = False,
             xi_hall = 0.5,
@@ -380,28 +593,63 @@ class PavlovianApp(QDialog):
         while columnCount > 0 and not any(self.tableWidget.getText(row, columnCount - 1) for row in range(rowCount)):
             columnCount -= 1
 
-        strengths = [History.emptydict() for _ in range(columnCount)]
-        phases = dict()
+        groups = []
         for row in range(rowCount):
             name = self.tableWidget.verticalHeaderItem(row).text()
             phase_strs = [self.tableWidget.getText(row, column) for column in range(columnCount)]
             if not any(phase_strs):
                 continue
 
-            group, local_phases = create_group_and_phase(name, phase_strs, args)
-            results = run_group_experiments(group, local_phases, args.num_trials)
-            local_strengths = group_results(results, name, args)
+            groups.append((name, phase_strs))
 
-            strengths = [a | b for a, b in zip(strengths, local_strengths)]
-            phases[name] = local_phases
+        return args, groups, columnCount
 
-        return strengths, phases, args
+    # Sends the current design to the worker, cancelling the job that is running, if any.
+    # The figures are replaced once the results are in.
+    def refreshExperiment(self, showPlots = False):
+        try:
+            args, groups, columnCount = self.readDesign()
+        except ValueError as e:
+            self.statusInfo.setText(f'Invalid parameter: {e}')
+            return
+
+        if not groups:
+            return
+
+        self.jobId += 1
+        self.jobStart = time.monotonic()
+        self.showPlots = showPlots
+        self.statusInfo.setText('Running...')
+        profile = self.profileCheckbox.checkState() == Qt.CheckState.Checked
+        self.worker.request(self.jobId, groups, args, columnCount, int(self.jobs.box.text() or '1'), profile)
+
+    def jobProgress(self, jobId : int, text : str):
+        if jobId == self.jobId:
+            self.statusInfo.setText(text)
+
+    def jobFailed(self, jobId : int, text : str):
+        if jobId == self.jobId:
+            self.statusInfo.setText(text)
+
+    def jobFinished(self, jobId : int, result):
+        if jobId != self.jobId:
+            return
+
+        strengths, phases, args = result
+        self.statusInfo.setText(f'Done in {time.monotonic() - self.jobStart:.2f}s')
+
+        if self.showPlots:
+            show_plots(
+                strengths,
+                phases = phases,
+                plot_alpha = args.plot_alpha,
+                plot_macknhall = args.plot_macknhall,
+            )
+            return
 
-    def refreshExperiment(self):
         for fig in self.figures:
             pyplot.close(fig)
 
-        strengths, phases, args = self.generateResults()
         self.numPhases = max(len(v) for v in phases.values())
         self.phase = min(self.phase, self.numPhases)
         print(self.phase, self.numPhases)
@@ -412,7 +660,7 @@ class PavlovianApp(QDialog):
             plot_alpha = args.plot_alpha,
             plot_macknhall = args.plot_macknhall,
         )
-        
+
         self.refreshFigure()
 
     def refreshFigure(self):
@@ -427,15 +675,11 @@ class PavlovianApp(QDialog):
         self.phaseInfo.setText(f'Phase {self.phase}/{self.numPhases}')
 
     def plotExperiment(self):
-        strengths, phases, args = self.generateResults()
-        show_plots(
-            strengths,
-            phases = phases,
-            plot_alpha = args.plot_alpha,
-            plot_macknhall = args.plot_macknhall,
-        )
+        self.refreshExperiment(showPlots = True)
 
-        return strengths
+    def closeEvent(self, event):
+        self.worker.stop()
+        super().closeEvent(event)
 
     def updateWidgets(self):
         self.tableWidget.update()
@@ -457,8 +701,22 @@ class PavlovianApp(QDialog):
         self.phase += 1 
         self.refreshFigure()
 
+# The cache is off unless --cache-dir is given, like in the simulator; other arguments are left to Qt.
+def parse_args():
+    parser = argparse.ArgumentParser(description="Rescorla-Wagner model simulator")
+    parser.add_argument("--cache-dir", type = str, help = 'Directory in which to keep the results of each group, which are reused when nothing that affects them has changed')
+    parser.add_argument("--cache-size", type = float, default = 512, help = 'Maximum size of the cache, in MiB. The least recently used results are removed first')
+    args, _ = parser.parse_known_args()
+    return args
+
 if __name__ == '__main__':
+    args = parse_args()
+
+    cache = None
+    if args.cache_dir is not None:
+        cache = ResultCache(args.cache_dir, max_bytes = int(args.cache_size * 2**20))
+
     app = QApplication(sys.argv)
-    gallery = PavlovianApp()
+    gallery = PavlovianApp(cache)
     gallery.show()
     sys.exit(app.exec())
@@ -0,0 +1,122 @@
+import argparse
+import itertools
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from Experiment import run_all_groups
+from Export import write_data
+from Strengths import History
+from Sweep import parse_grid, point_args
+
+ADAPTIVE_TYPES = ['linear', 'exponential', 'mack', 'hall', 'macknhall', 'dualV', 'newDualV', 'lepelley', 'dualmack', 'hybrid']
+
+def read_design(path : str) -> list[tuple[str, list[str]]]:
+    groups = []
+    with open(path) as file:
+        for experiment in file.readlines():
+            if not experiment.strip():
+                continue
+
+            name, *phase_strs = experiment.strip().split('|')
+            groups.append((name.strip(), phase_strs))
+
+    return groups
+
+# run_design runs every group of a design with a single adaptive type, and writes its output to
+# `{output_dir}/{adaptive_type}-{experiment}`, followed by `_{phase}.png` for figures or by the extension of the data format.
+# The plotting modules are only imported when figures are asked for.
+def run_design(experiment : str, groups : list[tuple[str, list[str]]], adaptive_type : str, opts : argparse.Namespace) -> tuple[str, float]:
+    start = time.perf_counter()
+
+    args = point_args(opts.point | {'adaptive_type': adaptive_type}, opts.seed)
+    args.batched = opts.batched
+    args.plot_alpha = opts.plot_alpha
+    args.plot_macknhall = opts.plot_macknhall
+
+    strengths = [History.emptydict() for _ in groups[0][1]]
+    phases = dict()
+    for (name, _), (local_strengths, local_phases) in zip(groups, run_all_groups(groups, args)):
+        strengths = [a | b for a, b in zip(strengths, local_strengths)]
+        phases[name] = local_phases
+
+    filename = os.path.join(opts.output_dir, f'{adaptive_type}-{experiment}')
+    if opts.format != 'png':
+        write_data(strengths, f'{filename}.{opts.format}')
+    else:
+        import matplotlib
+        matplotlib.use('Agg')
+        from Plots import save_plots
+
+        save_plots(
+            strengths,
+            phases = phases,
+            filename = filename,
+            plot_alpha = args.plot_alpha,
+            plot_macknhall = args.plot_macknhall,
+        )
+
+    return filename, time.perf_counter() - start
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description = 'Run several experiment files with several adaptive types in a single process',
+        epilog = 'Parameters are given as NAME=VALUE, where NAME is a parameter such as alpha, beta, beta_neg, gamma, thetaE, thetaI, window_size or num_trials, or alpha_X for the alpha of CS X.',
+    )
+
+    parser.add_argument('experiment_files', nargs = '+', help = 'Paths to the experiment files')
+    parser.add_argument('--adaptive-types', nargs = '+', choices = ADAPTIVE_TYPES, default = ADAPTIVE_TYPES, help = 'Adaptive types to run every experiment with. By default all of them')
+    parser.add_argument('--set', nargs = '*', default = [], help = 'Parameters to use instead of the defaults')
+    parser.add_argument('--output-dir', default = 'Plots', help = 'Directory where the figures or data files are written')
+    parser.add_argument('--format', choices = ['png', 'csv', 'json', 'npz'], default = 'png', help = 'Whether to save figures of every phase, or a data file with the histories of every experiment')
+    parser.add_argument('--seed', type = int, help = 'Seed for randomised phases')
+    parser.add_argument('--batched', type = bool, action = argparse.BooleanOptionalAction, default = False, help = 'Run all the trials of randomised phases at once as a batch of arrays')
+    parser.add_argument('--jobs', type = int, default = 1, help = 'Number of processes across which the runs are spread')
+    parser.add_argument('--plot-alpha', type = bool, action = argparse.BooleanOptionalAction, default = False, help = 'Whether to plot the total alpha')
+    parser.add_argument('--plot-macknhall', type = bool, action = argparse.BooleanOptionalAction, default = False, help = 'Whether to plot the alpha Mack and alpha Hall')
+
+    args = parser.parse_args()
+
+    points = parse_grid(args.set)
+    if len(points) != 1:
+        parser.error('--set takes a single value per parameter')
+    args.point = points[0]
+
+    if 'adaptive_type' in args.point:
+        parser.error('Use --adaptive-types to choose the adaptive types')
+
+    return args
+
+def main():
+    args = parse_args()
+    os.makedirs(args.output_dir, exist_ok = True)
+
+    # Each design is read once, and shared by every adaptive type.
+    designs = []
+    for path in args.experiment_files:
+        experiment = os.path.splitext(os.path.basename(path))[0]
+        designs.append((experiment, read_design(path)))
+
+    combinations = list(itertools.product(designs, args.adaptive_types))
+    experiments = [experiment for (experiment, _), _ in combinations]
+    groups = [groups for (_, groups), _ in combinations]
+    adaptive_types = [adaptive_type for _, adaptive_type in combinations]
+
+    executor = None
+    run = map
+    if args.jobs > 1:
+        executor = ProcessPoolExecutor(max_workers = args.jobs)
+        run = executor.map
+
+    start = time.perf_counter()
+    for filename, elapsed in run(run_design, experiments, groups, adaptive_types, itertools.repeat(args)):
+        print(f'{filename}: {elapsed:.2f}s', file = sys.stderr)
+
+    if executor is not None:
+        executor.shutdown()
+
+    print(f'{len(combinations)} runs in {time.perf_counter() - start:.2f}s', file = sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,480 @@
+from __future__ import annotations
+import math
+import random
+from collections import deque
+from collections.abc import Callable
+
+import numpy
+
+from Group import Group
+from Strengths import Individual, Strengths, History, Welford
+
+# Fields of an Individual that are simulated in the batch, in the order of the last axis of the
+# recorded histories.
+FIELDS = ('assoc', 'Ve', 'Vi', 'alpha', 'alpha_mack', 'alpha_hall', 'delta_ma_hall')
+
+# Elementwise versions of the libm functions used by Group.step. NumPy's own exp and power
+# differ from libm in the last bit for some values, which would break bit-for-bit equality.
+_exp = numpy.frompyfunc(math.exp, 1, 1)
+_pow = numpy.frompyfunc(math.pow, 2, 1)
+
+def exp(x : numpy.ndarray) -> numpy.ndarray:
+    return _exp(x).astype(numpy.float64)
+
+def pow(x : numpy.ndarray, y : float) -> numpy.ndarray:
+    return _pow(x, y).astype(numpy.float64)
+
+# Vectorised versions of every branch of Group.step.
+# Each kernel receives the fields `v` of a single CS for every replicate where the CS is present,
+# the group parameters `p`, and the per-replicate trial values, and updates `v` with the same
+# operations, in the same order, as Group.step.
+def linear(v, p, beta, lamda, sign, sigma, sigmaE, sigmaI, prev_lamda):
+    delta_v_factor = beta * (prev_lamda - sigma)
+    v['alpha'] = v['alpha'] * (1 + sign * 0.05)
+    v['assoc'] = v['assoc'] + v['alpha'] * delta_v_factor
+
+def exponential(v, p, beta, lamda, sign, sigma, sigmaE, sigmaI, prev_lamda):
+    delta_v_factor = beta * (prev_lamda - sigma)
+    v['alpha'] = numpy.where(sign == 1, v['alpha'] * pow(v['alpha'], 0.05), v['alpha'])
+    v['assoc'] = v['assoc'] + v['alpha'] * delta_v_factor
+
+def alpha_mack(v, sigma):
+    return 1/2 * (1 + 2*v['assoc'] - sigma)
+
+def alpha_hall(v, sigma, lamda):
+    surprise = abs(lamda - sigma)
+    gamma = 0.99
+    return gamma*surprise + (1-gamma)*v['alpha_hall']
+
+def mack(v, p, beta, lamda, sign, sigma, sigmaE, sigmaI, prev_lamda):
+    delta_v_factor = beta * (prev_lamda - sigma)
+    v['alpha_mack'] = alpha_mack(v, sigma)
+    v['alpha'] = v['alpha_mack']
+    v['assoc'] = v['assoc'] * delta_v_factor + delta_v_factor/2*beta
+
+def hall(v, p, beta, lamda, sign, sigma, sigmaE, sigmaI, prev_lamda):
+    v['alpha_hall'] = alpha_hall(v, sigma, prev_lamda)
+    v['alpha'] = v['alpha_hall']
+    v['assoc'] = v['assoc'] + v['alpha'] * beta * (lamda - sigma)
+
+def macknhall(v, p, beta, lamda, sign, sigma, sigmaE, sigmaI, prev_lamda):
+    delta_v_factor = beta * (prev_lamda - sigma)
+    v['alpha_mack'] = alpha_mack(v, sigma)
+    v['alpha_hall'] = alpha_hall(v, sigma, prev_lamda)
+    v['alpha'] = (1 - abs(prev_lamda - sigma)) * v['alpha_mack'] + v['alpha_hall']
+    v['assoc'] = v['assoc'] + v['alpha'] * delta_v_factor
+
+def dualV(v, p, beta, lamda, sign, sigma, sigmaE, sigmaI, prev_lamda, gamma = None):
+    rho = lamda - (sigmaE - sigmaI)
+    if gamma is None:
+        gamma = p['gamma']
+
+    pos = rho >= 0
+    v['Ve'] = numpy.where(pos, v['Ve'] + p['betap'] * v['alpha'] * lamda, v['Ve'])
+    v['Vi'] = numpy.where(pos, v['Vi'], v['Vi'] + p['betan'] * v['alpha'] * abs(rho))
+
+    v['alpha'] = gamma * abs(rho) + (1 - gamma) * v['alpha']
+    v['assoc'] = v['Ve'] - v['Vi']
+
+def newDualV(v, p, beta, lamda, sign, sigma, sigmaE, sigmaI, prev_lamda):
+    gamma = 1 - exp(-v['delta_ma_hall']**2)
+    dualV(v, p, beta, lamda, sign, sigma, sigmaE, sigmaI, prev_lamda, gamma = gamma)
+
+def lepelley(v, p, beta, lamda, sign, sigma, sigmaE, sigmaI, prev_lamda):
+    rho = lamda - (sigmaE - sigmaI)
+
+    VXe = sigmaE - v['Ve']
+    VXi = sigmaI - v['Vi']
+
+    pos = rho >= 0
+    DVe = numpy.where(pos, v['alpha'] * p['betap'] * (1 - v['Ve'] + v['Vi']) * abs(rho), 0.)
+    DVi = numpy.where(pos, 0., v['alpha'] * p['betan'] * (1 - v['Vi'] + v['Ve']) * abs(rho))
+
+    excitatory = v['alpha'] + -p['thetaE'] * (abs(lamda - v['Ve'] + v['Vi']) - abs(lamda - VXe + VXi))
+    inhibitory = v['alpha'] + -p['thetaI'] * (abs(abs(rho) - v['Vi'] + v['Ve']) - abs(abs(rho) - VXi + VXe))
+    v['alpha'] = numpy.where(rho > 0, excitatory, numpy.where(pos, v['alpha'], inhibitory))
+
+    v['alpha'] = numpy.minimum(numpy.maximum(v['alpha'], 0.05), 1)
+    v['Ve'] = v['Ve'] + DVe
+    v['Vi'] = v['Vi'] + DVi
+
+    v['assoc'] = v['Ve'] - v['Vi']
+
+def dualmack(v, p, beta, lamda, sign, sigma, sigmaE, sigmaI, prev_lamda):
+    rho = lamda - (sigmaE - sigmaI)
+
+    VXe = sigmaE - v['Ve']
+    VXi = sigmaI - v['Vi']
+
+    pos = rho >= 0
+    v['Ve'] = numpy.where(pos, v['Ve'] + v['alpha'] * p['betap'] * (1 - v['Ve'] + v['Vi']) * abs(rho), v['Ve'])
+    v['Vi'] = numpy.where(pos, v['Vi'], v['Vi'] + v['alpha'] * p['betan'] * (1 - v['Vi'] + v['Ve']) * abs(rho))
+
+    v['alpha'] = 1/2 * (1 + v['assoc'] - (VXe - VXi))
+    v['assoc'] = v['Ve'] - v['Vi']
+
+def hybrid(v, p, beta, lamda, sign, sigma, sigmaE, sigmaI, prev_lamda):
+    rho = lamda - (sigmaE - sigmaI)
+
+    pos = rho >= 0
+    NVe = numpy.where(pos, v['Ve'] + v['alpha_hall'] * p['betap'] * (1 - v['Ve'] + v['Vi']) * abs(rho), v['Ve'])
+    NVi = numpy.where(pos, v['Vi'], v['Vi'] + v['alpha_hall'] * p['betan'] * (1 - v['Vi'] + v['Ve']) * abs(rho))
+
+    VXe = sigmaE - v['Ve']
+    VXi = sigmaI - v['Vi']
+    excitatory = v['alpha_mack'] + -p['thetaE'] * (abs(lamda - v['Ve'] + v['Vi']) - abs(lamda - VXe + VXi))
+    inhibitory = v['alpha_mack'] + -p['thetaI'] * (abs(abs(rho) - v['Vi'] + v['Ve']) - abs(abs(rho) - VXi + VXe))
+    v['alpha_mack'] = numpy.where(rho > 0, excitatory, numpy.where(rho < 0, inhibitory, v['alpha_mack']))
+
+    v['alpha_mack'] = numpy.minimum(numpy.maximum(v['alpha_mack'], 0.05), 1)
+    v['alpha_hall'] = p['gamma'] * abs(rho) + (1 - p['gamma']) * v['alpha_hall']
+
+    v['Ve'] = NVe
+    v['Vi'] = NVi
+
+    v['assoc'] = v['alpha_mack'] * (v['Ve'] - v['Vi'])
+
+KERNELS = {
+    'linear': linear,
+    'exponential': exponential,
+    'mack': mack,
+    'hall': hall,
+    'macknhall': macknhall,
+    'dualV': dualV,
+    'newDualV': newDualV,
+    'lepelley': lepelley,
+    'dualmack': dualmack,
+    'hybrid': hybrid,
+}
+
+# Copying or constructing an Individual resets Ve and Vi to assoc, and replaces falsy
+# alpha_mack and alpha_hall by alpha; `constructed` applies the same to arrays of fields.
+def constructed(x : numpy.ndarray) -> numpy.ndarray:
+    x = x.copy()
+    assoc, alpha = FIELDS.index('assoc'), FIELDS.index('alpha')
+    x[..., FIELDS.index('Ve')] = x[..., assoc]
+    x[..., FIELDS.index('Vi')] = x[..., assoc]
+    for prop in ('alpha_mack', 'alpha_hall'):
+        e = FIELDS.index(prop)
+        x[..., e] = numpy.where(x[..., e] == 0, x[..., alpha], x[..., e])
+
+    return x
+
+# SequentialMean averages rows in the same order as Strengths.avg: it adds `x / n` one row at a time,
+# rather than using NumPy's pairwise summation, so the results are bit-for-bit the same.
+class SequentialMean:
+    n : int
+    total : None | numpy.ndarray
+
+    def __init__(self, n : int):
+        self.n = n
+        self.total = None
+
+    def add(self, rows : numpy.ndarray):
+        for row in rows / self.n:
+            if self.total is None:
+                self.total = row
+            else:
+                self.total = self.total + row
+
+# BatchRun holds the state of `n` replicates of a group in arrays of shape (n, number of CS).
+class BatchRun:
+    def __init__(self, g : Group, cs : list[str], n : int, params : None | dict = None):
+        self.g = g
+        self.cs = cs
+        self.index = {k: e for e, k in enumerate(cs)}
+
+        initial = constructed(numpy.array([[getattr(g.s.s[k], prop) for prop in FIELDS] for k in cs], dtype = numpy.float64))
+        self.state = numpy.repeat(initial[numpy.newaxis], n, axis = 0)
+
+        if params is None:
+            params = {k: getattr(g, k) for k in ('betap', 'betan', 'gamma', 'thetaE', 'thetaI')}
+        self.params = params
+
+        self.window = None
+        if g.window_size is not None:
+            self.window = numpy.zeros((n, len(cs), g.window_size))
+            self.window_len = numpy.zeros((n, len(cs)), dtype = numpy.int64)
+            for e, k in enumerate(cs):
+                window = g.s.s[k].window
+                assert len(window) <= g.window_size
+                self.window[:, e, g.window_size - len(window):] = list(window)
+                self.window_len[:, e] = len(window)
+
+    def field(self, c : int, prop : str) -> numpy.ndarray:
+        return self.state[:, c, FIELDS.index(prop)]
+
+    # Runs a single trial position for every replicate, where replicate `r` sees compound
+    # `compounds[r]` (a list of CS indices, in the order in which Group.runPhase sums them).
+    def step(self, kernel, compounds : numpy.ndarray, beta, lamda, sign, prev_lamda) -> numpy.ndarray:
+        present = numpy.zeros(self.state.shape[:2], dtype = bool)
+        rows = numpy.arange(self.state.shape[0])
+
+        sigma = numpy.zeros(self.state.shape[0])
+        sigmaE = numpy.zeros(self.state.shape[0])
+        sigmaI = numpy.zeros(self.state.shape[0])
+        for j in range(compounds.shape[1]):
+            col = compounds[:, j]
+            valid = col >= 0
+            present[rows[valid], col[valid]] = True
+            sigma = sigma + numpy.where(valid, self.state[rows, col, FIELDS.index('assoc')], 0.)
+            sigmaE = sigmaE + numpy.where(valid, self.state[rows, col, FIELDS.index('Ve')], 0.)
+            sigmaI = sigmaI + numpy.where(valid, self.state[rows, col, FIELDS.index('Vi')], 0.)
+
+        for c in range(len(self.cs)):
+            mask = present[:, c]
+            if not mask.any():
+                continue
+
+            v = {prop: self.state[mask, c, e] for e, prop in enumerate(FIELDS)}
+            prev_assoc = v['assoc']
+            p = {k: x[mask] if isinstance(x, numpy.ndarray) else x for k, x in self.params.items()}
+            with numpy.errstate(all = 'ignore'):
+                kernel(v, p, beta[mask], lamda[mask], sign[mask], sigma[mask], sigmaE[mask], sigmaI[mask], prev_lamda[mask])
+
+            if self.window is not None:
+                window = self.window[mask, c]
+                window = numpy.concatenate([window[:, 1:], v['assoc'][:, numpy.newaxis]], axis = 1)
+                length = self.window_len[mask, c]
+                length = numpy.where(length >= self.g.window_size, length, length + 1)
+
+                total = numpy.zeros(window.shape[0])
+                for j in range(window.shape[1]):
+                    total = total + window[:, j]
+
+                v['delta_ma_hall'] = total / length - prev_assoc
+                self.window[mask, c] = window
+                self.window_len[mask, c] = length
+
+            for e, prop in enumerate(FIELDS):
+                self.state[mask, c, e] = v[prop]
+
+        return present
+
+# run_batched_phase runs `num_trials` shuffled replicates of a randomised phase in lockstep, and
+# returns the same averaged histories as the `rand` branch of run_group_experiments.
+# It also sets `g.s` to the average final strengths, and leaves `phase.elems` in its last shuffled order.
+# With `variance`, the standard error of the associative strengths is kept in the histories.
+# `progress` is called with the number of replicates done after every chunk.
+def run_batched_phase(g : Group, phase, num_trials : int, chunk_size : int = 4096, variance : bool = False, progress : None | Callable[[int], None] = None) -> dict[str, History]:
+    types = sorted(set(phase.elems))
+    codes = [types.index(x) for x in phase.elems]
+
+    # Build all the permutations up front, consuming `random` exactly like repeated calls to random.shuffle.
+    perms = numpy.empty((num_trials, len(codes)), dtype = numpy.int32)
+    for r in range(num_trials):
+        random.shuffle(codes)
+        perms[r] = codes
+    phase.elems[:] = [types[x] for x in codes]
+
+    cs = sorted(g.s.s.keys())
+    index = {k: e for e, k in enumerate(cs)}
+
+    compounds = [[index[x] for x in g.compounds(part)] for part, _ in types]
+    width = max(len(x) for x in compounds)
+    compounds = numpy.array([x + [-1] * (width - len(x)) for x in compounds], dtype = numpy.int64)
+
+    beta = numpy.array([g.betap if plus == '+' else g.betan for _, plus in types])
+    lamda = numpy.array([(phase.lamda or g.lamda) if plus == '+' else 0. for _, plus in types])
+    sign = numpy.array([1 if plus == '+' else -1 for _, plus in types])
+
+    # prev_lamda carries over from one replicate to the next.
+    last_lamda = numpy.concatenate([[g.prev_lamda], lamda[perms[:-1, -1]]])
+
+    phase_cs = sorted({index[x] for part, _ in types for x in g.compounds(part)})
+    counts = {c: int((compounds[perms[0]] == c).any(axis = 1).sum()) for c in phase_cs}
+
+    kernel = KERNELS.get(g.adaptive_type)
+    if kernel is None:
+        raise NameError(f'Unknown adaptive type {g.adaptive_type}!')
+
+    hist_mean = {c: SequentialMean(num_trials) for c in phase_cs}
+    welford = {c: Welford() for c in phase_cs}
+    final_mean = SequentialMean(num_trials)
+    window_mean = SequentialMean(num_trials)
+
+    for start in range(0, num_trials, chunk_size):
+        chunk = perms[start : start + chunk_size]
+        n = chunk.shape[0]
+
+        run = BatchRun(g, cs, n)
+        hist = {c: numpy.empty((n, counts[c] + 1, len(FIELDS))) for c in phase_cs}
+        seen = {c: numpy.zeros(n, dtype = numpy.int64) for c in phase_cs}
+        for c in phase_cs:
+            hist[c][:, 0] = run.state[:, c]
+
+        prev_lamda = last_lamda[start : start + n]
+        rows = numpy.arange(n)
+        for t in range(chunk.shape[1]):
+            kind = chunk[:, t]
+            present = run.step(kernel, compounds[kind], beta[kind], lamda[kind], sign[kind], prev_lamda)
+            prev_lamda = lamda[kind]
+
+            for c in phase_cs:
+                mask = present[:, c]
+                seen[c][mask] += 1
+                hist[c][rows[mask], seen[c][mask]] = run.state[mask, c]
+
+        for c in phase_cs:
+            hist_mean[c].add(constructed(hist[c]))
+            if variance:
+                for row in hist[c][:, :, FIELDS.index('assoc')]:
+                    welford[c].add(row)
+        final_mean.add(constructed(run.state))
+        if run.window is not None:
+            window_mean.add(run.window)
+
+        if progress is not None:
+            progress(start + n)
+
+    g.prev_lamda = float(lamda[perms[-1, -1]])
+
+    histories = {}
+    for c in phase_cs:
+        mean = constructed(hist_mean[c].total)
+        columns = {prop: mean[:, e] for e, prop in enumerate(FIELDS)}
+        if variance:
+            columns['se'] = welford[c].se()
+
+        histories[cs[c]] = History.fromColumns(columns)
+
+    final = {}
+    for c, k in enumerate(cs):
+        window = None
+        if run.window is not None:
+            length = int(run.window_len[0, c])
+            window = deque(map(float, window_mean.total[c, run.window.shape[2] - length:]))
+
+        final[k] = Individual(window = window, **dict(zip(FIELDS, map(float, final_mean.total[c]))))
+    g.s = Strengths(s = final)
+
+    return histories
+
+# Parameters that can take a different value in every row of run_population, besides `alpha_X` for the
+# alpha of a single CS X.
+POPULATION_PARAMS = ('alpha', 'beta', 'beta_neg', 'lamda', 'gamma', 'thetaE', 'thetaI')
+
+# run_population runs every phase of a new group for `n` sets of parameters at once, one per row of the batch.
+# `values` maps parameters in POPULATION_PARAMS, or `alpha_X`, to arrays of `n` values; the rest are those of `g`.
+# alpha_mack and alpha_hall start equal to alpha, unless they are also given in `values`.
+# Randomised phases run `num_trials` replicates of every set, all of them with the same shuffles, which are drawn
+# from `random` like in run_batched_phase; every set goes on to the next phase with the average of its replicates.
+# It returns, for every phase, the assoc of each CS at every step of every set, as arrays of shape (n, steps).
+# `g` itself is left unchanged.
+def run_population(g : Group, phases : list, values : dict[str, numpy.ndarray], n : int, num_trials : int) -> list[dict[str, numpy.ndarray]]:
+    kernel = KERNELS.get(g.adaptive_type)
+    if kernel is None:
+        raise NameError(f'Unknown adaptive type {g.adaptive_type}!')
+
+    def param(name : str, default : float) -> numpy.ndarray:
+        return numpy.broadcast_to(numpy.asarray(values.get(name, default), dtype = numpy.float64), (n,)).copy()
+
+    betap = param('beta', g.betap)
+    betan = param('beta_neg', g.betan)
+    lamda = param('lamda', g.lamda)
+    prev_lamda = param('lamda', g.prev_lamda)
+    params = {
+        'betap': betap,
+        'betan': betan,
+        'gamma': param('gamma', g.gamma),
+        'thetaE': param('thetaE', g.thetaE),
+        'thetaI': param('thetaI', g.thetaI),
+    }
+
+    cs = sorted(g.s.s.keys())
+    index = {k: e for e, k in enumerate(cs)}
+    assoc = FIELDS.index('assoc')
+
+    run = BatchRun(g, cs, n, params)
+    for c, k in enumerate(cs):
+        alpha = values.get(f'alpha_{k}', values.get('alpha'))
+        if alpha is None:
+            continue
+
+        run.state[:, c, FIELDS.index('alpha')] = alpha
+        for prop in ('alpha_mack', 'alpha_hall'):
+            run.state[:, c, FIELDS.index(prop)] = values.get(prop, alpha)
+
+    results = []
+    for phase in phases:
+        types = sorted(set(phase.elems))
+        members = [g.compounds(part) for part, _ in types]
+        if any(len(x) > 1 for x in sum(members, [])):
+            raise ValueError('Configural cues are not supported when running a population')
+
+        members = [[index[x] for x in part] for part in members]
+        width = max(len(x) for x in members)
+        compounds = numpy.array([x + [-1] * (width - len(x)) for x in members], dtype = numpy.int64)
+        phase_cs = sorted(set(sum(members, [])))
+
+        # Values of every trial type for every set, of shape (types, n).
+        plus = numpy.array([x == '+' for _, x in types])[:, numpy.newaxis]
+        type_beta = numpy.where(plus, betap, betan)
+        type_lamda = numpy.where(plus, numpy.full(n, phase.lamda) if phase.lamda else lamda, 0.)
+        type_sign = numpy.where(plus[:, 0], 1, -1)
+
+        codes = [types.index(x) for x in phase.elems]
+        if not phase.rand:
+            hist = {c: [run.state[:, c, assoc].copy()] for c in phase_cs}
+            for kind in codes:
+                run.step(kernel, numpy.broadcast_to(compounds[kind], (n, width)), type_beta[kind], type_lamda[kind], numpy.full(n, type_sign[kind]), prev_lamda)
+                prev_lamda = type_lamda[kind]
+
+                for c in members[kind]:
+                    hist[c].append(run.state[:, c, assoc].copy())
+
+            results.append({cs[c]: numpy.stack(x, axis = 1) for c, x in hist.items()})
+            continue
+
+        perms = numpy.empty((num_trials, len(codes)), dtype = numpy.int64)
+        for r in range(num_trials):
+            random.shuffle(codes)
+            perms[r] = codes
+        phase.elems[:] = [types[x] for x in codes]
+
+        # Row `i * num_trials + j` is replicate j of set i.
+        size = n * num_trials
+        rows = numpy.arange(size)
+        kinds = numpy.tile(perms, (n, 1))
+        row_beta = numpy.repeat(type_beta, num_trials, axis = 1)
+        row_lamda = numpy.repeat(type_lamda, num_trials, axis = 1)
+
+        # prev_lamda carries over from one replicate to the next.
+        last = numpy.empty((n, num_trials))
+        last[:, 0] = prev_lamda
+        last[:, 1:] = type_lamda[perms[:-1, -1]].T
+        row_prev_lamda = last.reshape(size)
+
+        # Every replicate starts from a copy of the state, as in run_group_experiments.
+        run.state = constructed(numpy.repeat(run.state, num_trials, axis = 0))
+        run.params = {k: numpy.repeat(v, num_trials) for k, v in params.items()}
+        if run.window is not None:
+            run.window = numpy.repeat(run.window, num_trials, axis = 0)
+            run.window_len = numpy.repeat(run.window_len, num_trials, axis = 0)
+
+        counts = {c: sum(1 for x in perms[0] if c in members[x]) for c in phase_cs}
+        hist = {c: numpy.empty((size, counts[c] + 1)) for c in phase_cs}
+        seen = {c: numpy.zeros(size, dtype = numpy.int64) for c in phase_cs}
+        for c in phase_cs:
+            hist[c][:, 0] = run.state[:, c, assoc]
+
+        for t in range(perms.shape[1]):
+            kind = kinds[:, t]
+            present = run.step(kernel, compounds[kind], row_beta[kind, rows], row_lamda[kind, rows], type_sign[kind], row_prev_lamda)
+            row_prev_lamda = row_lamda[kind, rows]
+
+            for c in phase_cs:
+                mask = present[:, c]
+                seen[c][mask] += 1
+                hist[c][rows[mask], seen[c][mask]] = run.state[mask, c, assoc]
+
+        results.append({cs[c]: x.reshape(n, num_trials, -1).mean(axis = 1) for c, x in hist.items()})
+
+        run.state = constructed(run.state.reshape(n, num_trials, *run.state.shape[1:]).mean(axis = 1))
+        run.params = params
+        if run.window is not None:
+            run.window = run.window.reshape(n, num_trials, *run.window.shape[1:]).mean(axis = 1)
+            run.window_len = run.window_len.reshape(n, num_trials, -1)[:, 0]
+        prev_lamda = type_lamda[perms[-1, -1]]
+
+    return results
@@ -0,0 +1,212 @@
+import argparse
+import copy
+import glob
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import numpy
+
+from Batch import read_design
+from Cache import code_version
+from Experiment import create_group_and_phase, run_all_phases
+from Kernels import KERNELS
+from Strengths import History
+from Sweep import point_args
+
+# A phase with simple and compound trials, both reinforced and not, which reaches every branch of the models.
+DESIGN = '200A+/200AB+/200B-/200AC-/200C+'
+
+def same(a : dict[str, History], b : dict[str, History]) -> bool:
+    return a.keys() == b.keys() and all(
+        numpy.array_equal(getattr(a[k], prop), getattr(b[k], prop), equal_nan = True)
+        for k in a
+        for prop in History.FIELDS
+    )
+
+# time_phase returns the best time of `repeat` runs of a phase on copies of the group, and the
+# histories of the last one.
+def time_phase(g, phase, repeat : int, reference : bool) -> tuple[float, dict[str, History]]:
+    best = float('inf')
+    for _ in range(repeat):
+        h = copy.deepcopy(g)
+        start = time.perf_counter()
+        hist = h.runPhase(phase.elems, phase.lamda, reference = reference)
+        best = min(best, time.perf_counter() - start)
+
+    return best, hist
+
+# measure returns the best wall time of `repeat` calls of `fn`, and the peak memory allocated by
+# one more call, which is traced separately so that tracing doesn't slow down the timed ones.
+def measure(fn, repeat : int) -> dict[str, float]:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'time': best, 'peak_bytes': peak}
+
+def run_groups(groups : list[tuple[str, list[str]]], args):
+    return [run_all_phases(name, phase_strs, args) for name, phase_strs in groups]
+
+# kernels compares, for every adaptive type, the time per trial of Group.step against the kernel
+# that replaces it, and checks that both give the same histories.
+def kernels(opts : argparse.Namespace) -> dict[str, dict[str, float]]:
+    results = {}
+
+    print(f'{"adaptive type":<14} {"step (µs)":>10} {"kernel (µs)":>12} {"speedup":>8}  identical')
+    for adaptive_type in KERNELS:
+        args = point_args({'adaptive_type': adaptive_type}, seed = None)
+
+        random.seed(0)
+        g, (phase,) = create_group_and_phase('Benchmark', [DESIGN], args)
+        random.shuffle(phase.elems)
+
+        step_time, step_hist = time_phase(g, phase, opts.repeat, reference = True)
+        kernel_time, kernel_hist = time_phase(g, phase, opts.repeat, reference = False)
+
+        step_us = step_time / len(phase.elems) * 1e6
+        kernel_us = kernel_time / len(phase.elems) * 1e6
+        print(f'{adaptive_type:<14} {step_us:>10.2f} {kernel_us:>12.2f} {step_us / kernel_us:>7.2f}x  {same(step_hist, kernel_hist)}')
+
+        results[f'kernels/{adaptive_type}/step'] = {'time': step_time}
+        results[f'kernels/{adaptive_type}/kernel'] = {'time': kernel_time}
+
+    return results
+
+# suite times every group of every experiment file with every adaptive type.
+def suite(opts : argparse.Namespace) -> dict[str, dict[str, float]]:
+    results = {}
+    for path in opts.experiments:
+        experiment = os.path.splitext(os.path.basename(path))[0]
+        groups = read_design(path)
+
+        for adaptive_type in opts.adaptive_types:
+            args = point_args({'adaptive_type': adaptive_type, 'num_trials': opts.num_trials}, opts.seed)
+            args.batched = opts.batched
+
+            name = f'suite/{experiment}/{adaptive_type}'
+            results[name] = measure(lambda: run_groups(groups, args), opts.repeat)
+            print(f'{name:<50} {results[name]["time"]:>9.4f}s {results[name]["peak_bytes"] / 2**20:>9.2f} MiB', file = sys.stderr)
+
+    return results
+
+# Designs whose cost grows along each axis of the scaling curves, as (groups, num_trials) for a size.
+CUES = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+SCALING = {
+    'trials': lambda n: ([('G', [f'{n}A+/{n}AB+', f'{n}B-'])], 1),
+    'cues': lambda n: ([('G', [f'50{CUES[:n]}+/50{CUES[0]}-'])], 1),
+    'replicates': lambda n: ([('G', ['rand/20A+/20AX-', '10X+'])], n),
+    'groups': lambda n: ([(f'G{e}', ['50A+/50AB+', '50B-']) for e in range(n)], 1),
+}
+
+# scaling times a single adaptive type along each axis in SCALING, for every size in `opts.sizes`.
+def scaling(opts : argparse.Namespace) -> dict[str, dict[str, float]]:
+    results = {}
+    for axis, design in SCALING.items():
+        for size in opts.sizes:
+            if axis == 'cues' and size > len(CUES):
+                continue
+
+            groups, num_trials = design(size)
+            args = point_args({'adaptive_type': opts.adaptive_type, 'num_trials': num_trials}, opts.seed)
+            args.batched = opts.batched
+
+            name = f'scaling/{opts.adaptive_type}/{axis}/{size}'
+            results[name] = measure(lambda: run_groups(groups, args), opts.repeat)
+            print(f'{name:<50} {results[name]["time"]:>9.4f}s {results[name]["peak_bytes"] / 2**20:>9.2f} MiB', file = sys.stderr)
+
+    return results
+
+# compare prints the ratio of every time in `results` to the same one in `baseline`, and returns
+# the names of those that are slower by more than `threshold`.
+def compare(results : dict[str, dict[str, float]], baseline : dict[str, dict[str, float]], threshold : float) -> list[str]:
+    regressions = []
+
+    print(f'{"benchmark":<50} {"baseline":>10} {"now":>10} {"ratio":>7} {"memory":>7}')
+    for name, now in results.items():
+        if name not in baseline:
+            continue
+
+        ratio = now['time'] / baseline[name]['time']
+        memory = ''
+        if 'peak_bytes' in now and 'peak_bytes' in baseline[name]:
+            memory = f'{now["peak_bytes"] / max(baseline[name]["peak_bytes"], 1):.2f}x'
+
+        mark = ''
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            mark = '  slower'
+
+        print(f'{name:<50} {baseline[name]["time"]:>9.4f}s {now["time"]:>9.4f}s {ratio:>6.2f}x {memory:>7}{mark}')
+
+    return regressions
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description = 'Benchmarks of the simulator')
+    parser.add_argument('--repeat', type = int, default = 5, help = 'Number of times each measurement is repeated; the best one is kept')
+    parser.add_argument('--batched', type = bool, action = argparse.BooleanOptionalAction, default = False, help = 'Run randomised phases as a batch of arrays')
+    parser.add_argument('--seed', type = int, default = 0, help = 'Seed for randomised phases')
+    parser.add_argument('--output', help = 'JSON file in which to write the results')
+    parser.add_argument('--compare', type = argparse.FileType('r'), help = 'JSON file written by an earlier run, to compare against. The exit status is 1 if anything got slower than the threshold')
+    parser.add_argument('--threshold', type = float, default = .1, help = 'Relative slowdown above which a benchmark counts as slower than the baseline')
+
+    commands = parser.add_subparsers(dest = 'command', required = True)
+
+    commands.add_parser('kernels', help = 'Time per trial of Group.step against the kernels of every adaptive type')
+
+    suite_parser = commands.add_parser('suite', help = 'Every experiment file with every adaptive type')
+    suite_parser.add_argument('--experiments', nargs = '+', default = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Experiments', '*.rw'))), help = 'Experiment files. By default, everything in Experiments/')
+    suite_parser.add_argument('--adaptive-types', nargs = '+', choices = list(KERNELS), default = list(KERNELS), help = 'Adaptive types. By default all of them')
+    suite_parser.add_argument('--num-trials', type = int, default = 100, help = 'Amount of trials done in randomised phases')
+
+    scaling_parser = commands.add_parser('scaling', help = 'Time and memory as the trials per phase, cues, randomised replicates and groups grow')
+    scaling_parser.add_argument('--adaptive-type', choices = list(KERNELS), default = 'dualV', help = 'Adaptive type to use')
+    scaling_parser.add_argument('--sizes', type = int, nargs = '+', default = [1, 4, 16, 64, 256], help = 'Sizes along every axis')
+
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    match args.command:
+        case 'kernels':
+            results = kernels(args)
+        case 'suite':
+            results = suite(args)
+        case 'scaling':
+            results = scaling(args)
+
+    if args.output is not None:
+        data = {
+            'meta': {
+                'command': args.command,
+                'batched': args.batched,
+                'python': platform.python_version(),
+                'numpy': numpy.__version__,
+                'machine': platform.machine(),
+                'code_version': code_version(),
+            },
+            'results': results,
+        }
+        with open(args.output, 'w') as file:
+            json.dump(data, file, indent = 2)
+
+    if args.compare is not None:
+        regressions = compare(results, json.load(args.compare)['results'], args.threshold)
+        if regressions:
+            print(f'{len(regressions)} benchmarks are slower than the baseline', file = sys.stderr)
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+import pickle
+
+from Experiment import Phase, simulation_args
+
+# Source files of the model; results are only reused while these are unchanged.
+SOURCES = ('Batched.py', 'Experiment.py', 'Group.py', 'Kernels.py', 'Samplers.py', 'Strengths.py')
+
+def code_version() -> str:
+    digest = hashlib.sha256()
+    for source in SOURCES:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), source), 'rb') as file:
+            digest.update(file.read())
+
+    return digest.hexdigest()
+
+# ResultCache stores the results of run_group on disk, along with the phases they were found in, in one
+# file per group named after the hash of everything that determines them: the group's name and phases,
+# the parameters, and the code.
+# When the files take more than `max_bytes`, the least recently used ones are removed.
+class ResultCache:
+    directory : str
+    max_bytes : int
+
+    hits : int
+    misses : int
+    evictions : int
+
+    def __init__(self, directory : str, max_bytes : int = 512 * 2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.version = code_version()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(directory, exist_ok = True)
+
+    # Returns the key of a group, or None if its results can't be cached: randomised phases
+    # without a seed give different results every time.
+    def key(self, name : str, phase_strs : list[str], args) -> None | str:
+        if args.seed is None and any(Phase(x).rand for x in phase_strs):
+            return None
+
+        desc = {
+            'version': self.version,
+            'name': name,
+            'phases': [x.strip() for x in phase_strs],
+            'args': simulation_args(args),
+        }
+
+        return hashlib.sha256(json.dumps(desc, sort_keys = True).encode()).hexdigest()
+
+    def path(self, key : str) -> str:
+        return os.path.join(self.directory, f'{key}.pickle')
+
+    def get(self, key : str):
+        try:
+            with open(self.path(key), 'rb') as file:
+                ret = pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+
+        # The modification time marks when an entry was last used.
+        os.utime(self.path(key))
+        self.hits += 1
+        return ret
+
+    def put(self, key : str, value):
+        path = self.path(key)
+        with open(path + '.tmp', 'wb') as file:
+            pickle.dump(value, file, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+
+        self.evict()
+
+    def entries(self) -> list[os.DirEntry]:
+        return [x for x in os.scandir(self.directory) if x.name.endswith('.pickle')]
+
+    def evict(self):
+        entries = sorted(self.entries(), key = lambda x: x.stat().st_mtime)
+        total = sum(x.stat().st_size for x in entries)
+        while entries and total > self.max_bytes:
+            oldest = entries.pop(0)
+            total -= oldest.stat().st_size
+            os.remove(oldest.path)
+            self.evictions += 1
+
+    def clear(self):
+        for entry in self.entries():
+            os.remove(entry.path)
+
+    def report(self) -> str:
+        entries = self.entries()
+        size = sum(x.stat().st_size for x in entries)
+        return '\n'.join([
+            f'Cache {self.directory}',
+            f'  hits:      {self.hits}',
+            f'  misses:    {self.misses}',
+            f'  evictions: {self.evictions}',
+            f'  entries:   {len(entries)}',
+            f'  size:      {size / 2**20:.2f} of {self.max_bytes / 2**20:.2f} MiB',
+        ])
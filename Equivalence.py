@@ -0,0 +1,257 @@
+import argparse
+import dataclasses
+import random
+import sys
+from dataclasses import dataclass
+
+import numpy
+
+from Batch import ADAPTIVE_TYPES, read_design
+from Experiment import Phase, RWArgs, create_group_and_phase, run_group_experiments
+from Strengths import History
+from Sweep import point_args
+
+# Alternative engines, as the changes each makes to the arguments of the reference run.
+ENGINES = {
+    'kernels': {},
+    'batched': {'batched': True},
+    'fast-forward': {'fast_forward': True},
+    'steady-state': {'steady_state': 0.},
+}
+
+# Arguments of the reference run: stepping every trial with Group.step.
+REFERENCE = {'batched': False, 'fast_forward': False, 'steady_state': None}
+
+CUES = 'ABCDEFGH'
+
+# Designs that fuzz checks with every adaptive type along with the random ones. Their runs are long enough for the
+# alpha of linear to grow past the point where beta times the sum of alphas reaches 1, and then to overflow.
+LONG_DESIGNS = [
+    ['20000A+'],
+    ['300AB+', '500A-'],
+    ['rand/200A+/200AB-', '16000B+'],
+]
+
+# Number of steps shown on each side of a divergence.
+CONTEXT = 2
+
+# Divergence is the first step at which a candidate engine records a different value than the reference.
+# A step of None means that the histories differ in shape, or that one of the runs failed.
+@dataclass
+class Divergence:
+    engine : str
+    group : str
+    phase : None | int = None
+    phase_str : None | str = None
+    cs : None | str = None
+    field : None | str = None
+    step : None | int = None
+    trial : None | int = None
+    reference : None | float = None
+    candidate : None | float = None
+    message : str = ''
+
+    # Values of the field around the step, in the reference and in the candidate.
+    reference_context : list[float] = dataclasses.field(default_factory = list)
+    candidate_context : list[float] = dataclasses.field(default_factory = list)
+
+    def __str__(self) -> str:
+        where = f'{self.engine}: group {self.group}'
+        if self.phase is not None:
+            where += f', phase {self.phase} ({self.phase_str.strip()})'
+        if self.step is None:
+            return f'{where}: {self.message}'
+
+        return '\n'.join([
+            f'{where}, {self.cs}.{self.field} at step {self.step}{"" if self.trial is None else f" (trial {self.trial})"}: {self.reference!r} != {self.candidate!r}',
+            f'  reference: {self.reference_context}',
+            f'  candidate: {self.candidate_context}',
+        ])
+
+# run runs the phases of a group like run_group, seeded from `args.seed` and the name of the group
+# whether or not it's set, and returns the History of each of its CS in every phase.
+def run(name : str, phase_strs : list[str], args : RWArgs, reference : bool = False) -> list[dict[str, History]]:
+    random.seed(f'{args.seed}:{name}')
+    g, phases = create_group_and_phase(name, phase_strs, args)
+    return run_group_experiments(g, phases, args.num_trials, batched = args.batched, reference = reference)
+
+# trial_numbers returns the number of the trial of a phase after which every step in the history of `cs`
+# was recorded, with 0 for the record before its first trial. Randomised phases are recorded in a different
+# order in every replicate, so for them it returns None.
+def trial_numbers(phase : Phase, cs : str, use_configurals : bool) -> None | list[int]:
+    if phase.rand:
+        return None
+
+    ret = [0]
+    for e, (part, _) in enumerate(phase.elems, start = 1):
+        if cs in set(part) or (use_configurals and cs == part):
+            ret.append(e)
+
+    return ret
+
+# compare returns the first step, in order of phases and trials, at which any field of any CS in `candidate`
+# is not close to `reference`, or None if none is. Values are close if |candidate - reference| <= atol + rtol * |reference|,
+# and NaNs are only close to each other.
+def compare(engine : str, name : str, phase_strs : list[str], reference : list[dict[str, History]], candidate : list[dict[str, History]], rtol : float, atol : float, use_configurals : bool = False) -> None | Divergence:
+    if len(reference) != len(candidate):
+        return Divergence(engine, name, message = f'{len(candidate)} phases, rather than {len(reference)}')
+
+    for phase_num, (ref, cand) in enumerate(zip(reference, candidate), start = 1):
+        phase_str = phase_strs[phase_num - 1]
+        phase = Phase(phase_str)
+        if ref.keys() != cand.keys():
+            return Divergence(engine, name, phase_num, phase_str, message = f'CSs {sorted(cand)}, rather than {sorted(ref)}')
+
+        first = None
+        for cs in sorted(ref, key = lambda x: (len(x), x)):
+            if len(ref[cs]) != len(cand[cs]):
+                return Divergence(engine, name, phase_num, phase_str, cs, message = f'{len(cand[cs])} steps of {cs}, rather than {len(ref[cs])}')
+
+            trials = trial_numbers(phase, cs, use_configurals)
+            for field in History.FIELDS:
+                a = getattr(ref[cs], field)
+                b = getattr(cand[cs], field)
+
+                bad = numpy.flatnonzero(~numpy.isclose(b, a, rtol = rtol, atol = atol, equal_nan = True))
+                if not len(bad):
+                    continue
+
+                step = int(bad[0])
+                trial = None if trials is None else trials[step]
+                order = step if trial is None else trial
+                if first is None or order < first[0]:
+                    first = (order, cs, field, step, trial, a, b)
+
+        if first is not None:
+            _, cs, field, step, trial, a, b = first
+            window = slice(max(step - CONTEXT, 0), step + CONTEXT + 1)
+            return Divergence(
+                engine, name, phase_num, phase_str, cs, field, step, trial, float(a[step]), float(b[step]),
+                reference_context = a[window].tolist(),
+                candidate_context = b[window].tolist(),
+            )
+
+    return None
+
+# check runs a group with the reference and with every engine, and returns the first divergence of each
+# engine that has one. If the reference itself fails, the group is skipped and None is returned.
+def check(name : str, phase_strs : list[str], args : RWArgs, engines : list[str], rtol : float, atol : float) -> None | list[Divergence]:
+    try:
+        reference = run(name, phase_strs, dataclasses.replace(args, **REFERENCE), reference = True)
+    except Exception:
+        return None
+
+    ret = []
+    for engine in engines:
+        try:
+            candidate = run(name, phase_strs, dataclasses.replace(args, **ENGINES[engine]))
+        except Exception as e:
+            ret.append(Divergence(engine, name, message = f'failed with {e!r}'))
+            continue
+
+        divergence = compare(engine, name, phase_strs, reference, candidate, rtol, atol, args.use_configurals)
+        if divergence is not None:
+            ret.append(divergence)
+
+    return ret
+
+# random_design returns the phases of a random group: between 1 and `max_phases` phases, each with up to
+# `max_parts` trial types made of cues from a random set, reinforced or not, and sometimes randomised
+# or with their own lamda.
+def random_design(rng : random.Random, max_cues : int = 4, max_phases : int = 3, max_parts : int = 4, max_count : int = 20) -> list[str]:
+    cues = rng.sample(CUES, rng.randint(1, max_cues))
+
+    phase_strs = []
+    for _ in range(rng.randint(1, max_phases)):
+        parts = []
+        if rng.random() < .3:
+            parts.append('rand')
+        if rng.random() < .2:
+            parts.append(f'lamda={rng.choice(["0", "0.5", "1", "2"])}')
+
+        for _ in range(rng.randint(1, max_parts)):
+            cs = ''.join(rng.sample(cues, rng.randint(1, len(cues))))
+            parts.append(f'{rng.randint(1, max_count)}{cs}{rng.choice("+-")}')
+
+        phase_strs.append('/'.join(parts))
+
+    return phase_strs
+
+# random_args returns the arguments of a run with a random adaptive type, configurals and learning rates.
+def random_args(rng : random.Random, adaptive_types : list[str], num_trials : int, seed : int) -> RWArgs:
+    return point_args({
+        'adaptive_type': rng.choice(adaptive_types),
+        'use_configurals': rng.random() < .2,
+        'alpha': rng.choice([.05, .1, .3, .5]),
+        'beta': rng.choice([.1, .3, .5]),
+        'beta_neg': rng.choice([.1, .2, .5]),
+        'gamma': rng.choice([.1, .5, .9]),
+        'num_trials': num_trials,
+    }, seed)
+
+def report(divergences : list[Divergence], args : RWArgs, phase_strs : list[str]) -> None:
+    for divergence in divergences:
+        print(divergence)
+        print(f'  design: {"|".join(phase_strs)}')
+        print(f'  adaptive type: {args.adaptive_type}, configurals: {args.use_configurals}, alpha: {args.alpha}, beta: {args.beta}, beta_neg: {args.beta_neg}, gamma: {args.gamma}')
+
+def parse_args() -> argparse.Namespace:
+    # Options shared by every command, which follow its name.
+    common = argparse.ArgumentParser(add_help = False)
+    common.add_argument('--engines', nargs = '+', choices = list(ENGINES), default = list(ENGINES), help = 'Engines to check. By default all of them')
+    common.add_argument('--adaptive-types', nargs = '+', choices = ADAPTIVE_TYPES, default = ADAPTIVE_TYPES, help = 'Adaptive types. By default all of them')
+    common.add_argument('--rtol', type = float, default = 1e-9, help = 'Relative tolerance of every recorded value')
+    common.add_argument('--atol', type = float, default = 1e-12, help = 'Absolute tolerance of every recorded value')
+    common.add_argument('--num-trials', type = int, default = 10, help = 'Amount of trials done in randomised phases')
+    common.add_argument('--seed', type = int, default = 0, help = 'Seed for randomised phases, and for the designs of fuzz')
+
+    parser = argparse.ArgumentParser(description = 'Check that the alternative engines of the simulator give the same results as Group.step')
+    commands = parser.add_subparsers(dest = 'command', required = True)
+
+    check_parser = commands.add_parser('check', parents = [common], help = 'Every group of some experiment files, with every adaptive type')
+    check_parser.add_argument('experiment_files', nargs = '+', help = 'Paths to the experiment files')
+    check_parser.add_argument('--use-configurals', type = bool, action = argparse.BooleanOptionalAction, default = False, help = 'Use compound stimuli with configural cues')
+
+    fuzz_parser = commands.add_parser('fuzz', parents = [common], help = 'Random designs with random parameters')
+    fuzz_parser.add_argument('--count', type = int, default = 200, help = 'Number of random designs')
+
+    return parser.parse_args()
+
+def main():
+    opts = parse_args()
+
+    cases = []
+    match opts.command:
+        case 'check':
+            for path in opts.experiment_files:
+                for adaptive_type in opts.adaptive_types:
+                    args = point_args({'adaptive_type': adaptive_type, 'use_configurals': opts.use_configurals, 'num_trials': opts.num_trials}, opts.seed)
+                    cases.extend((name, phase_strs, args) for name, phase_strs in read_design(path))
+
+        case 'fuzz':
+            rng = random.Random(opts.seed)
+            for e in range(opts.count):
+                phase_strs = random_design(rng)
+                cases.append((f'Fuzz{e}', phase_strs, random_args(rng, opts.adaptive_types, opts.num_trials, opts.seed)))
+
+            for e, phase_strs in enumerate(LONG_DESIGNS):
+                for adaptive_type in opts.adaptive_types:
+                    args = point_args({'adaptive_type': adaptive_type, 'num_trials': opts.num_trials}, opts.seed)
+                    cases.append((f'Long{e}', phase_strs, args))
+
+    failed = 0
+    skipped = 0
+    for name, phase_strs, args in cases:
+        divergences = check(name, phase_strs, args, opts.engines, opts.rtol, opts.atol)
+        if divergences is None:
+            skipped += 1
+        elif divergences:
+            failed += 1
+            report(divergences, args, phase_strs)
+
+    print(f'{len(cases)} groups, {failed} with divergences, {skipped} skipped because the reference failed', file = sys.stderr)
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,24 @@
+import copy
 import random
 import re
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import Executor
 from dataclasses import dataclass
+from itertools import repeat
 
+import numpy
+
+import Profile
+from Batched import run_batched_phase
 from Group import Group
-from Strengths import Strengths, History
+from Samplers import SAMPLERS
+from Strengths import Strengths, History, RunningAverage
 
 class Phase:
-    # elems contains a list of ([CS], US) of an experiment.
-    elems : list[tuple[str, str]]
+    # runs contains a list of ([CS], US, count) of an experiment: `count` consecutive
+    # presentations of the same trial.
+    runs : list[tuple[str, str, int]]
 
     # Whether this phase should be randomised.
     rand : bool
@@ -18,15 +29,44 @@ class Phase:
     # String description of this phase.
     phase_str : str
 
+    # Number of replicates run of a randomised phase, once it has been run.
+    replicates : None | int
+
+    # Largest standard error of the mean assoc of any CS at any step of a randomised phase, once it has
+    # been run one replicate at a time, if it was plotted, stopped on or reported for a sampler.
+    se : None | float
+
+    # Largest difference between the mean assoc of any CS at any step of a randomised phase run in expectation,
+    # and that of its replicates, if they were compared.
+    divergence : None | float
+
     # Return the set of single (one-character) CS.
     def cs(self):
-        return set.union(*[set(x[0]) for x in self.elems])
+        return set.union(*[set(x[0]) for x in self.runs])
+
+    # Return the set of compound (several CS) stimuli of this phase, with their CS sorted.
+    def compounds(self):
+        return {''.join(sorted(x[0])) for x in self.runs if len(x[0]) > 1}
+
+    # elems contains a list of ([CS], US) of an experiment, one per trial.
+    # It's only expanded from the runs when needed, such as to shuffle a randomised phase; shuffling
+    # it doesn't change the runs.
+    @property
+    def elems(self) -> list[tuple[str, str]]:
+        if self._elems is None:
+            self._elems = [(cs, sign) for cs, sign, count in self.runs for _ in range(count)]
+
+        return self._elems
 
     def __init__(self, phase_str : str):
         self.phase_str = phase_str
         self.rand = False
         self.lamda = None
-        self.elems = []
+        self.runs = []
+        self.replicates = None
+        self.se = None
+        self.divergence = None
+        self._elems = None
 
         for part in phase_str.strip().split('/'):
             if part == 'rand':
@@ -35,7 +75,8 @@ class Phase:
                 self.lamda = float(match.group(1))
             elif (match := re.fullmatch(r'([0-9]*)([A-Z]+)([+-]?)', part)) is not None:
                 num, cs, sign = match.groups()
-                self.elems += int(num or '1') * [(cs, sign or '+')]
+                if int(num or '1') > 0:
+                    self.runs.append((cs, sign or '+', int(num or '1')))
             else:
                 raise ValueError(f'Part not understood: {part}')
 
@@ -65,10 +106,40 @@ class RWArgs:
     plot_stimuli: None | list[str] = None
     plot_alpha: bool = False
     plot_macknhall: bool = False
+    plot_se: bool = False
 
     title_suffix: None | str = None
     savefig: None | str = None
 
+    batched: bool = False
+    fast_forward: bool = False
+    steady_state: None | float = None
+
+    # If set, replicates of randomised phases are run in blocks until the standard error of every mean assoc is
+    # at most this, with num_trials as the maximum.
+    se_tolerance: None | float = None
+
+    # How the orders of the trials of randomised phases are drawn; one of Samplers.SAMPLERS.
+    sampler: str = 'shuffle'
+
+    # If set, randomised phases are run a single time in expectation, by Group.runExpected, rather than shuffled.
+    # With mean_field_check, their replicates are also run, and the largest difference kept in the phase.
+    mean_field: bool = False
+    mean_field_check: bool = False
+
+    # If set, the replicates of randomised phases are run in shards, each with its own stream of random numbers,
+    # and spread across replicate_jobs processes. The results don't depend on the number of processes.
+    shard_replicates: bool = False
+    replicate_jobs: int = 1
+
+    # If set, leading phases that several groups have in common, and that draw no random numbers, are run once for
+    # all of them. The results are the same.
+    share_prefixes: bool = True
+
+    # If set, every group is seeded from this and its name, so results don't depend on the
+    # order or the process in which the groups are run.
+    seed: None | int = None
+
 def create_group_and_phase(name: str, phase_strs: list[str], args) -> tuple[Group, list[Phase]]:
     phases = [Phase(phase_str) for phase_str in phase_strs]
 
@@ -90,51 +161,446 @@ def create_group_and_phase(name: str, phase_strs: list[str], args) -> tuple[Grou
         adaptive_type = args.adaptive_type,
         window_size = args.window_size,
         xi_hall = args.xi_hall,
+        fast_forward = args.fast_forward,
+        steady_tolerance = args.steady_state,
     )
 
     return g, phases
 
-def run_group_experiments(g : Group, experiment : list[Phase], num_trials : int) -> list[list[Strengths]]:
+# A Prefix is where a group picks up after leading phases that were run for it along with other groups: the number
+# of those phases, the strengths and prev_lamda at their end, and their results.
+Prefix = tuple[int, Strengths, float, list[dict[str, History]]]
+
+# fork_group creates a group like create_group_and_phase, and gives it the strengths and prev_lamda of a group
+# that already ran its first phases. Phases that draw no random numbers only change the CSs of their trials, so
+# the CSs that `strengths` doesn't have keep their initial strengths.
+def fork_group(name: str, phase_strs: list[str], args, strengths: None | Strengths = None, prev_lamda: None | float = None) -> tuple[Group, list[Phase]]:
+    g, phases = create_group_and_phase(name, phase_strs, args)
+    if strengths is not None:
+        g.s = Strengths(s = g.s.s | copy.deepcopy(strengths).s)
+        g.prev_lamda = prev_lamda
+
+    return g, phases
+
+# shareable returns whether a phase draws no random numbers, so that running it once for several groups
+# leaves the same results as running it for each.
+def shareable(phase: Phase, args) -> bool:
+    return not phase.rand or (args.mean_field and not args.mean_field_check and not (args.use_configurals and phase.compounds()))
+
+# run_prefixes runs the leading phases that groups share once for all of them, walking the trie of their phases,
+# and returns the Prefix of every group that shares any, or None. Phases are the same if they run the same trials,
+# whatever their strings, and only those that can be shared, up to the first that can't, are in the trie.
+# The groups are run with the same `args`, so they start from the same strengths.
+def run_prefixes(groups: list[tuple[str, list[str]]], args) -> list[None | Prefix]:
+    keys = []
+    for _, phase_strs in groups:
+        key = []
+        for phase in map(Phase, phase_strs):
+            if not shareable(phase, args):
+                break
+            key.append((phase.rand, phase.lamda, tuple(phase.runs)))
+        keys.append(key)
+
+    ret = [None] * len(groups)
+    def visit(depth: int, members: list[int], strengths: None | Strengths, prev_lamda: None | float, results: list[dict[str, History]]):
+        children = {}
+        for e in members:
+            if depth < len(keys[e]):
+                children.setdefault(keys[e][depth], []).append(e)
+
+        for e in members:
+            if depth > 0 and (depth == len(keys[e]) or len(children[keys[e][depth]]) == 1):
+                ret[e] = (depth, strengths, prev_lamda, results)
+
+        for child in children.values():
+            if len(child) == 1:
+                continue
+
+            name, phase_strs = groups[child[0]]
+            g, phases = fork_group(name, phase_strs[:depth + 1], args, strengths, prev_lamda)
+            hist = run_group_experiments(g, phases[depth:], args.num_trials, first_phase = depth, mean_field = args.mean_field)
+            visit(depth + 1, child, g.s, g.prev_lamda, results + hist)
+
+    visit(0, list(range(len(groups))), None, None, [])
+    return ret
+
+# Fields of RWArgs that change the results of a group. Fields that only change how the results are
+# computed (batched) or plotted are left out.
+SIMULATION_FIELDS = ('alphas', 'alpha', 'alpha_mack', 'alpha_hall', 'beta', 'beta_neg', 'lamda', 'gamma', 'thetaE', 'thetaI', 'use_configurals', 'adaptive_type', 'window_size', 'xi_hall', 'num_trials', 'seed', 'plot_se', 'fast_forward', 'steady_state', 'se_tolerance', 'sampler', 'mean_field', 'mean_field_check', 'shard_replicates')
+
+# Number of replicates run between checks of the standard error, with se_tolerance.
+REPLICATE_BLOCK = 50
+
+# Number of replicates in every shard of a randomised phase, with shard_replicates.
+SHARD_SIZE = REPLICATE_BLOCK
+
+def simulation_args(args) -> dict:
+    return {k: getattr(args, k, None) for k in SIMULATION_FIELDS}
+
+# shard_orders returns the orders of the replicates in shard `shard` of a randomised phase, in the blocks drawn by
+# `sampler`. Every shard draws them from a stream of its own, seeded from the `key` of the phase and its number,
+# so they are the same whichever process runs it.
+def shard_orders(phase : Phase, sampler : str, key : int, shard : int, num_trials : int) -> list[list[list[tuple[str, str]]]]:
+    count = min(SHARD_SIZE, num_trials - shard * SHARD_SIZE)
+    rng = random.Random(f'{key}:{shard}')
+    return [[list(order) for order in block] for block in SAMPLERS[sampler](list(phase.elems), count, rng)]
+
+# run_shard runs the replicates of a shard from the strengths of `g`, and returns their running sums, the sum
+# of their final strengths and the lamda of their last trial. Every replicate starts from the lamda of the last
+# trial of the one before it, as when they are run one after another, so the first one of a shard starts from that
+# of the last order of the shard before.
+def run_shard(g : Group, phase : Phase, sampler : str, key : int, shard : int, num_trials : int, variance : bool = False, reference : bool = False, blocks : bool = False) -> tuple[RunningAverage, Strengths, float]:
+    g = copy.deepcopy(g)
+    if shard > 0:
+        _, plus = shard_orders(phase, sampler, key, shard - 1, num_trials)[-1][-1][-1]
+        g.prev_lamda = phase.lamda or g.lamda if plus == '+' else 0.
+
+    initial_strengths = g.s
+    hist = RunningAverage(None, variance = variance, blocks = blocks)
+    final_strengths = None
+    for block in shard_orders(phase, sampler, key, shard, num_trials):
+        for e, order in enumerate(block):
+            g.s = initial_strengths.copy()
+            hist.add(g.runPhase(order, phase.lamda, reference = reference), block_end = e == len(block) - 1)
+            final_strengths = g.s if final_strengths is None else final_strengths + g.s
+
+    return hist, final_strengths, g.prev_lamda
+
+# submit_window is like executor.map, but only keeps `window` calls submitted ahead of the result that is being
+# waited for, so that nothing more is run once the caller stops iterating. The calls that are still pending then
+# are cancelled.
+def submit_window(executor : Executor, window : int, fn : Callable, *iterables):
+    pending = deque()
+    try:
+        for args in zip(*iterables):
+            if len(pending) >= window:
+                yield pending.popleft().result()
+            pending.append(executor.submit(fn, *args))
+
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+# If `snapshots` is given, a copy of the group and the state of `random` are appended to it after each phase.
+# `progress`, if given, is called with the index of the phase and the number of replicates of it that are
+# done, after every phase and as randomised phases advance. It can raise an exception to stop the run.
+# `first_phase` is the number of the first phase in `experiment`, counting from 0, which is only used
+# to label the profile.
+# With `reference`, every trial is run by Group.step, which the faster paths are checked against.
+# Randomised phases with configural cues are never batched, as their compounds have no strengths of their own.
+# With `se_tolerance`, replicates of randomised phases are run in blocks of REPLICATE_BLOCK until the standard
+# error of the mean assoc of every CS at every step is at most `se_tolerance`, or `num_trials` have been run.
+# These are never batched either. The number of replicates of each randomised phase is kept in its `replicates`.
+# `sampler` is the name of the sampler in Samplers.py that draws the orders of the replicates. Only `shuffle`
+# is batched; the standard error of the others is computed from their blocks, and kept in the phase's `se`.
+# With `mean_field`, randomised phases without configural cues are run in expectation instead. With `mean_field_check`
+# as well, their replicates are run on a copy of the group, and the largest difference from them is kept in the
+# phase's `divergence`.
+# With `sharded`, the replicates of randomised phases are run by run_shard, in shards of SHARD_SIZE seeded from a key
+# drawn from `random` for every phase, and spread across `executor` if given, with at most `window` of them submitted
+# at a time. The shards are folded in order, so the averages and final strengths are the same whatever the executor.
+# They are checked against `se_tolerance` one by one, and the shards after the one that meets it are not run.
+def run_group_experiments(g : Group, experiment : list[Phase], num_trials : int, batched : bool = False, variance : bool = False, snapshots : None | list[tuple[Group, tuple]] = None, progress : None | Callable[[int, int], None] = None, first_phase : int = 0, reference : bool = False, se_tolerance : None | float = None, sampler : str = 'shuffle', mean_field : bool = False, mean_field_check : bool = False, sharded : bool = False, executor : None | Executor = None, window : int = 1) -> list[dict[str, History]]:
     results = []
 
     for trial, phase in enumerate(experiment):
+        phase_progress = None
+        if progress is not None:
+            phase_progress = lambda done, phase_num = trial: progress(phase_num, done)
+
+        labels = (g.name, first_phase + trial + 1, g.adaptive_type)
+
+        # The standard error is only estimated when it's plotted, stopped on or reported for a sampler.
+        blocks = variance or se_tolerance is not None or sampler != 'shuffle'
+        trials = sum(count for _, _, count in phase.runs)
+
         if not phase.rand:
-            strength_hist = g.runPhase(phase.elems, phase.lamda)
+            with Profile.stage('runPhase', *labels):
+                strength_hist = g.runRuns(phase.runs, phase.lamda, reference = reference)
+                Profile.count('trials', trials)
+            results.append(strength_hist)
+        elif mean_field and not (g.use_configurals and phase.compounds()):
+            replicates = None
+            if mean_field_check:
+                mc = copy.deepcopy(g)
+                with Profile.stage('mean_field_check', *labels):
+                    [replicates] = run_group_experiments(mc, [phase], num_trials, batched = batched, variance = variance, sampler = sampler)
+
+            with Profile.stage('mean_field', *labels):
+                strength_hist = g.runExpected(phase.runs, phase.lamda)
+                Profile.count('trials', trials)
             results.append(strength_hist)
+
+            if replicates is not None:
+                phase.divergence = max(float(numpy.abs(strength_hist[cs].assoc - replicates[cs].assoc).max()) for cs in strength_hist)
+        elif sharded:
+            key = random.getrandbits(64)
+            shards = range(-(-num_trials // SHARD_SIZE))
+
+            hist = RunningAverage(None, variance = variance, blocks = blocks)
+            final_strengths = None
+            run = map if executor is None else lambda *xs: submit_window(executor, window, *xs)
+            with Profile.stage('shards', *labels):
+                for shard_hist, shard_strengths, prev_lamda in run(run_shard, repeat(g), repeat(phase), repeat(sampler), repeat(key), shards, repeat(num_trials), repeat(variance), repeat(reference), repeat(blocks)):
+                    hist.merge(shard_hist)
+                    final_strengths = shard_strengths if final_strengths is None else final_strengths + shard_strengths
+                    Profile.count('trials', trials * shard_hist.count)
+                    Profile.count('replicates', shard_hist.count)
+
+                    if phase_progress is not None:
+                        phase_progress(hist.count)
+
+                    if se_tolerance is not None and hist.max_se() <= se_tolerance:
+                        break
+
+            results.append(hist.result())
+            g.s = final_strengths / hist.count
+            g.prev_lamda = prev_lamda
+            phase.replicates = hist.count
+            if blocks:
+                phase.se = hist.max_se()
+        elif batched and not reference and se_tolerance is None and sampler == 'shuffle' and not (g.use_configurals and phase.compounds()):
+            with Profile.stage('batched', *labels):
+                results.append(run_batched_phase(g, phase, num_trials, variance = variance, progress = phase_progress))
+                phase.replicates = num_trials
+                Profile.count('trials', trials * num_trials)
+                Profile.count('replicates', num_trials)
         else:
             initial_strengths = g.s.copy()
-            final_strengths = []
-            hist = []
 
-            for trial in range(num_trials):
-                random.shuffle(phase.elems)
+            # Each trial is folded into the averages as soon as it finishes, so that
+            # memory does not depend on num_trials.
+            # When the number of replicates isn't known in advance, the final strengths are added up,
+            # and divided by it at the end.
+            hist = RunningAverage(num_trials if se_tolerance is None else None, variance = variance, blocks = blocks)
+            final_strengths = None
+
+            checked = 0
+            for block in SAMPLERS[sampler](phase.elems, num_trials):
+                for e, order in enumerate(block):
+                    with Profile.stage('replicates', *labels):
+                        g.s = initial_strengths.copy()
+                        replicate = g.runPhase(order, phase.lamda, reference = reference)
+                        Profile.count('trials', trials)
+                        Profile.count('replicates')
+
+                    with Profile.stage('average', *labels):
+                        hist.add(replicate, block_end = e == len(block) - 1)
+
+                        final = g.s / num_trials if se_tolerance is None else g.s
+                        final_strengths = final if final_strengths is None else final_strengths + final
 
-                g.s = initial_strengths.copy()
-                hist.append(g.runPhase(phase.elems, phase.lamda))
-                final_strengths.append(g.s.copy())
+                    if phase_progress is not None:
+                        phase_progress(hist.count)
 
-            results.append([
-                Strengths.avg([h[x] for h in hist if x < len(h)])
-                for x in range(max(len(h) for h in hist))
-            ])
+                if se_tolerance is not None and hist.count - checked >= REPLICATE_BLOCK:
+                    checked = hist.count
+                    if hist.max_se() <= se_tolerance:
+                        break
 
-            g.s = Strengths.avg(final_strengths)
+            with Profile.stage('average', *labels):
+                results.append(hist.result())
+            g.s = final_strengths if se_tolerance is None else final_strengths / hist.count
+            phase.replicates = hist.count
+            if blocks:
+                phase.se = hist.max_se()
+
+        if snapshots is not None:
+            snapshots.append((copy.deepcopy(g), random.getstate()))
+
+        if phase_progress is not None:
+            phase_progress(num_trials if phase.rand else 1)
 
     return results
 
-def group_results(results: list[list[Strengths]], name: str, args: RWArgs) -> list[dict[str, History]]:
+# group_results returns, for every phase, the History of every simple CS and of the compounds that
+# appear in `phases` (or only of those in `args.plot_stimuli`, if set).
+# Compounds are only computed once per phase, from the histories of their CS.
+def group_results(results: list[dict[str, History]], name: str, args: RWArgs, phases: None | list[Phase] = None) -> list[dict[str, History]]:
+    compounds = set()
+    if phases is not None:
+        compounds = set.union(*[x.compounds() for x in phases])
+
+    if args.plot_stimuli is not None:
+        compounds |= set(args.plot_stimuli)
+
     group_strengths = [History.emptydict() for _ in results]
-    for phase_num, strength_hist in enumerate(results):
-        for strengths in strength_hist:
-            for cs in strengths.ordered_cs():
-                if args.plot_stimuli is None or cs in args.plot_stimuli:
-                    group_strengths[phase_num][f'{name} - {cs}'].add(strengths[cs])
+    for phase_num, histories in enumerate(results):
+        candidates = {x for x in histories.keys() if len(x) == 1} | compounds
+        for cs in sorted(candidates, key = lambda x: (len(x), x)):
+            if args.plot_stimuli is not None and cs not in args.plot_stimuli:
+                continue
+
+            if len(set(cs)) != len(cs) or any(x not in histories for x in cs):
+                continue
+
+            group_strengths[phase_num][f'{name} - {cs}'] = History.combine([histories[x] for x in cs])
 
     return group_strengths
 
+# run_group runs every phase of a single group, and returns the History of each of its CS in every
+# phase, along with the phases. The shards of its randomised phases are spread across `executor`, if given.
+# If the group shares its first phases with others, which were already run, `prefix` has the number of those phases
+# along with the strengths and prev_lamda at their end, and only the rest are run and returned.
+def run_group(name: str, phase_strs: list[str], args: RWArgs, executor: None | Executor = None, prefix: None | tuple[int, Strengths, float] = None) -> tuple[list[dict[str, History]], list[Phase]]:
+    if args.seed is not None:
+        random.seed(f'{args.seed}:{name}')
+
+    first_phase = 0
+    strengths, prev_lamda = None, None
+    if prefix is not None:
+        first_phase, strengths, prev_lamda = prefix
+
+    with Profile.stage('parse', name, model = args.adaptive_type):
+        group, phases = fork_group(name, phase_strs, args, strengths, prev_lamda)
+
+    results = run_group_experiments(group, phases[first_phase:], args.num_trials, first_phase = first_phase, batched = args.batched, variance = args.plot_se, se_tolerance = args.se_tolerance, sampler = args.sampler, mean_field = args.mean_field, mean_field_check = args.mean_field_check, sharded = args.shard_replicates, executor = executor, window = 2 * (args.replicate_jobs or 1))
+
+    return results, phases
+
 def run_all_phases(name: str, phase_strs: list[str], args: RWArgs):
-    group, phases = create_group_and_phase(name, phase_strs, args)
-    results = run_group_experiments(group, phases, args.num_trials)
-    strengths = group_results(results, name, args)
+    results, phases = run_group(name, phase_strs, args)
+    with Profile.stage('group_results', name, model = args.adaptive_type):
+        strengths = group_results(results, name, args, phases)
 
     return strengths, phases
+
+# run_all_groups runs several independent groups, given as (name, phase_strs), and returns their
+# strengths and phases in the same order as the groups.
+# If an executor is given, the groups are spread across it.
+# If a cache is given, groups whose results are already there are not run again.
+# If a replicate executor is given instead, the groups are run in this process, and the shards of their
+# randomised phases are spread across it.
+# With `args.share_prefixes`, the leading phases that groups share are run first, once, by run_prefixes.
+def run_all_groups(groups: list[tuple[str, list[str]]], args: RWArgs, executor: None | Executor = None, cache = None, replicate_executor: None | Executor = None) -> list[tuple[list[dict[str, History]], list[Phase]]]:
+    results = [None] * len(groups)
+    keys = [None] * len(groups)
+    if cache is not None:
+        for e, (name, phase_strs) in enumerate(groups):
+            keys[e] = cache.key(name, phase_strs, args)
+            if keys[e] is not None:
+                results[e] = cache.get(keys[e])
+
+    missing = [e for e, x in enumerate(results) if x is None]
+    names = [groups[e][0] for e in missing]
+    phase_strs = [groups[e][1] for e in missing]
+
+    # Groups are cached along with their phases, which keep the number of replicates, standard error and
+    # divergence of every randomised phase.
+    prefixes = [None] * len(missing)
+    if args.share_prefixes:
+        prefixes = run_prefixes(list(zip(names, phase_strs)), args)
+
+    run = map if executor is None or replicate_executor is not None else executor.map
+    starts = [None if x is None else x[:3] for x in prefixes]
+    for e, prefix, (hist, phases) in zip(missing, prefixes, run(run_group, names, phase_strs, repeat(args), repeat(replicate_executor), starts)):
+        if prefix is not None:
+            hist = prefix[3] + hist
+
+        results[e] = (hist, phases)
+        if keys[e] is not None:
+            cache.put(keys[e], results[e])
+
+    ret = []
+    for (name, phase_strs), (hist, phases) in zip(groups, results):
+        with Profile.stage('group_results', name, model = args.adaptive_type):
+            ret.append((group_results(hist, name, args, phases), phases))
+
+    return ret
+
+# GroupRun keeps the results of a group along with its state at the start of every phase, so that after
+# an edit it only runs again from the first phase that changed.
+class GroupRun:
+    name : str
+    args : RWArgs
+    phase_strs : list[str]
+    phases : list[Phase]
+    results : list[dict[str, History]]
+
+    # The group and the state of `random` at the start of each phase, and after the last one.
+    snapshots : list[tuple[Group, tuple]]
+
+    def __init__(self, name : str, args : RWArgs):
+        self.name = name
+        self.args = args
+        self.phase_strs = []
+        self.phases = []
+        self.results = []
+        self.snapshots = []
+
+    # load sets results computed elsewhere, such as in a cache, along with their phases. These have no
+    # snapshots, so the next change runs the whole group again.
+    def load(self, phase_strs : list[str], results : list[dict[str, History]], phases : list[Phase]):
+        self.phase_strs = list(phase_strs)
+        self.phases = phases
+        self.results = results
+        self.snapshots = []
+
+    def first_change(self, phase_strs : list[str]) -> int:
+        for e, (old, new) in enumerate(zip(self.phase_strs, phase_strs)):
+            if old.strip() != new.strip():
+                return e
+
+        return min(len(self.phase_strs), len(phase_strs))
+
+    # update brings the results up to date with `phase_strs`, and returns the number of phases that were run.
+    # `progress` is passed on to run_group_experiments, with phases numbered from the first one of the group.
+    # If the run is stopped by an exception, the GroupRun is left as it was.
+    def update(self, phase_strs : list[str], progress : None | Callable[[int, int], None] = None) -> int:
+        start = self.first_change(phase_strs)
+        if start == len(phase_strs) == len(self.phase_strs):
+            return 0
+
+        phases = [Phase(x) for x in phase_strs]
+        stimuli = set.union(*[x.cs() for x in phases])
+
+        # New CSs need to be in the group from the start.
+        if start >= len(self.snapshots) or not stimuli <= self.snapshots[start][0].s.cs:
+            start = 0
+
+        if start == 0:
+            if self.args.seed is not None:
+                random.seed(f'{self.args.seed}:{self.name}')
+
+            g, _ = create_group_and_phase(self.name, phase_strs, self.args)
+            snapshots = [(copy.deepcopy(g), random.getstate())]
+        else:
+            g, state = copy.deepcopy(self.snapshots[start])
+            random.setstate(state)
+            snapshots = self.snapshots[:start + 1]
+
+        # Phases that aren't run again keep what was found when they were.
+        phases[:start] = self.phases[:start]
+
+        phase_progress = None
+        if progress is not None:
+            phase_progress = lambda phase_num, done: progress(start + phase_num, done)
+
+        results = run_group_experiments(
+            g,
+            phases[start:],
+            self.args.num_trials,
+            batched = self.args.batched,
+            variance = self.args.plot_se,
+            snapshots = snapshots,
+            progress = phase_progress,
+            first_phase = start,
+            se_tolerance = self.args.se_tolerance,
+            sampler = self.args.sampler,
+            mean_field = self.args.mean_field,
+            mean_field_check = self.args.mean_field_check,
+            sharded = self.args.shard_replicates,
+        )
+
+        self.results = self.results[:start] + results
+        self.snapshots = snapshots
+        self.phase_strs = list(phase_strs)
+        self.phases = phases
+
+        return len(phases) - start
+
+def update_group_run(run : GroupRun, phase_strs : list[str]) -> GroupRun:
+    run.update(phase_strs)
+    return run
@@ -0,0 +1,64 @@
+import csv
+import json
+import os
+
+import numpy
+
+from Strengths import History
+
+# Columns of the exported histories, after the group, phase, cue and trial.
+COLUMNS = History.FIELDS + ('se',)
+
+# rows returns one row per group, phase, cue and trial of the strengths returned by group_results.
+def rows(strengths : list[dict[str, History]]) -> list[list]:
+    ret = []
+    for phase_num, experiments in enumerate(strengths, start = 1):
+        for key, hist in experiments.items():
+            group, cue = key.rsplit(' - ', 1)
+            columns = [getattr(hist, prop) for prop in COLUMNS]
+            for trial, values in enumerate(zip(*columns)):
+                ret.append([group, phase_num, cue, trial] + [repr(float(x)) for x in values])
+
+    return ret
+
+def write_csv(strengths : list[dict[str, History]], filename : str):
+    with open(filename, 'w', newline = '') as file:
+        writer = csv.writer(file)
+        writer.writerow(['group', 'phase', 'cue', 'trial', *COLUMNS])
+        writer.writerows(rows(strengths))
+
+# JSON has no NaN, so unknown standard errors are written as null.
+def write_json(strengths : list[dict[str, History]], filename : str):
+    data = []
+    for experiments in strengths:
+        data.append({
+            key: {prop: [None if numpy.isnan(x) else float(x) for x in getattr(hist, prop)] for prop in COLUMNS}
+            for key, hist in experiments.items()
+        })
+
+    with open(filename, 'w') as file:
+        json.dump(data, file)
+
+# Arrays are named `{phase}/{group} - {cue}/{field}`.
+def write_npz(strengths : list[dict[str, History]], filename : str):
+    arrays = {}
+    for phase_num, experiments in enumerate(strengths, start = 1):
+        for key, hist in experiments.items():
+            for prop in COLUMNS:
+                arrays[f'{phase_num}/{key}/{prop}'] = getattr(hist, prop)
+
+    numpy.savez(filename, **arrays)
+
+WRITERS = {
+    '.csv': write_csv,
+    '.json': write_json,
+    '.npz': write_npz,
+}
+
+# write_data writes the histories in the format given by the extension of `filename`.
+def write_data(strengths : list[dict[str, History]], filename : str):
+    extension = os.path.splitext(filename)[1]
+    if extension not in WRITERS:
+        raise ValueError(f'Unknown data format "{extension}"; use one of {", ".join(WRITERS)}')
+
+    WRITERS[extension](strengths, filename)
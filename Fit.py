@@ -0,0 +1,272 @@
+import argparse
+import csv
+import json
+import random
+import re
+import sys
+import time
+from collections import defaultdict
+
+import numpy
+
+from Batch import ADAPTIVE_TYPES, read_design
+from Batched import POPULATION_PARAMS, run_population
+from Experiment import RWArgs, create_group_and_phase
+from Sweep import parse_grid, point_args
+
+# Range searched for each parameter, unless another one is given. `alpha_X` uses that of alpha.
+BOUNDS = {
+    'alpha': (.01, 1.),
+    'beta': (.01, 1.),
+    'beta_neg': (.01, 1.),
+    'lamda': (.1, 2.),
+    'gamma': (0., 1.),
+    'thetaE': (0., 1.),
+    'thetaI': (0., 1.),
+}
+
+# Predicted probabilities are kept this far from 0 and 1, so that the likelihood is finite.
+EPSILON = 1e-6
+
+# Observations maps (group, phase, cue), with phases numbered from 1, to the steps of that phase at which
+# the cue was observed (0 being the start of the phase, like in the exported histories) and the responses.
+Observations = dict[tuple[str, int, str], tuple[numpy.ndarray, numpy.ndarray]]
+
+def read_observations(path : str, column : str = 'response') -> Observations:
+    values = defaultdict(list)
+    with open(path, newline = '') as file:
+        for row in csv.DictReader(file):
+            values[row['group'], int(row['phase']), row['cue']].append((int(row['trial']), float(row[column])))
+
+    return {
+        key: (numpy.array([x[0] for x in rows]), numpy.array([x[1] for x in rows]))
+        for key, rows in values.items()
+    }
+
+# parse_bounds turns specifications of the form `name` or `name=low:high` into the bounds of every parameter to fit.
+def parse_bounds(specs : list[str]) -> dict[str, tuple[float, float]]:
+    bounds = {}
+    for spec in specs:
+        match = re.fullmatch(r'([A-Za-z_]+)(?:=([^:]+):([^:]+))?', spec)
+        if match is None:
+            raise ValueError(f'Parameter specification not understood: {spec}')
+
+        name, low, high = match.groups()
+        if name not in POPULATION_PARAMS and re.fullmatch(r'alpha_[A-Z]', name) is None:
+            raise ValueError(f'Parameter {name} can\'t be fitted; use one of {", ".join(POPULATION_PARAMS)} or alpha_X')
+
+        if low is None:
+            low, high = BOUNDS['alpha' if name.startswith('alpha') else name]
+
+        bounds[name] = (float(low), float(high))
+
+    return bounds
+
+def sse(predicted : numpy.ndarray, observed : numpy.ndarray) -> numpy.ndarray:
+    return numpy.sum((predicted - observed) ** 2, axis = 1)
+
+# nll is the negative log-likelihood of responses between 0 and 1, taking the associative strength, clipped
+# to that range, as the probability of responding.
+def nll(predicted : numpy.ndarray, observed : numpy.ndarray) -> numpy.ndarray:
+    p = numpy.clip(predicted, EPSILON, 1 - EPSILON)
+    return -numpy.sum(observed * numpy.log(p) + (1 - observed) * numpy.log(1 - p), axis = 1)
+
+ERRORS = {
+    'sse': sse,
+    'nll': nll,
+}
+
+# Objective computes the error of many sets of parameters, given as the rows of an array, at once:
+# every group with observations is simulated a single time for all of them with run_population.
+# Randomised phases are seeded the same way in every call, so the same set always has the same error.
+class Objective:
+    groups : list[tuple[str, list[str]]]
+    observations : Observations
+    args : RWArgs
+    names : list[str]
+    error : str
+
+    # Number of sets of parameters evaluated so far.
+    evaluations : int
+
+    def __init__(self, groups : list[tuple[str, list[str]]], observations : Observations, args : RWArgs, names : list[str], error : str = 'sse'):
+        self.groups = [(name, phase_strs) for name, phase_strs in groups if any(x[0] == name for x in observations)]
+        self.observations = observations
+        self.args = args
+        self.names = names
+        self.error = error
+        self.evaluations = 0
+
+        known = {name for name, _ in groups}
+        for group, _, _ in observations:
+            if group not in known:
+                raise ValueError(f'There are observations of group {group}, which is not in the design')
+
+    # values returns the parameters of every row of `points` for run_population, along with the
+    # parameters that stay fixed but would otherwise follow alpha: alpha_mack and alpha_hall follow the alpha
+    # of every CS whose alpha is fitted, and alpha_X follows alpha.
+    def values(self, points : numpy.ndarray) -> dict[str, numpy.ndarray]:
+        values = {prop: getattr(self.args, prop) for prop in ('alpha_mack', 'alpha_hall') if getattr(self.args, prop) is not None}
+        values |= {name: points[:, e] for e, name in enumerate(self.names)}
+        if 'alpha' in values:
+            for cs, alpha in self.args.alphas.items():
+                values.setdefault(f'alpha_{cs}', alpha)
+
+        return values
+
+    def predictions(self, points : numpy.ndarray) -> dict[tuple[str, int, str], numpy.ndarray]:
+        values = self.values(points)
+
+        ret = {}
+        for name, phase_strs in self.groups:
+            if self.args.seed is not None:
+                random.seed(f'{self.args.seed}:{name}')
+
+            g, phases = create_group_and_phase(name, phase_strs, self.args)
+            assocs = run_population(g, phases, values, len(points), self.args.num_trials)
+
+            for (group, phase, cue), (trials, _) in self.observations.items():
+                if group != name:
+                    continue
+
+                if phase > len(assocs) or any(x not in assocs[phase - 1] for x in cue):
+                    raise ValueError(f'Cue {cue} is not in phase {phase} of group {group}')
+
+                # A compound is the sum of its CSs, at every step at which all of them are present.
+                arrays = [assocs[phase - 1][x] for x in cue]
+                size = min(x.shape[1] for x in arrays)
+                if trials.max() >= size:
+                    raise ValueError(f'Cue {cue} has {size} steps in phase {phase} of group {group}, but there are observations of step {trials.max()}')
+
+                ret[group, phase, cue] = sum(x[:, :size] for x in arrays)[:, trials]
+
+        return ret
+
+    def __call__(self, points : numpy.ndarray) -> numpy.ndarray:
+        total = numpy.zeros(len(points))
+        with numpy.errstate(all = 'ignore'):
+            for key, predicted in self.predictions(points).items():
+                total += ERRORS[self.error](predicted, self.observations[key][1])
+
+        self.evaluations += len(points)
+        return numpy.where(numpy.isfinite(total), total, numpy.inf)
+
+# differential_evolution minimises `objective` within `bounds`, an array of (low, high) for every parameter,
+# with the DE/rand/1/bin strategy. Each generation evaluates its whole population with one call of `objective`.
+# It stops after `generations`, or once the errors of the population are all within `tol` of each other.
+# `callback` is called after every generation with its number and the best point and error so far.
+def differential_evolution(objective, bounds : numpy.ndarray, popsize : int, generations : int, rng : numpy.random.Generator, mutation : float = .7, crossover : float = .9, tol : float = 1e-10, callback = None) -> tuple[numpy.ndarray, float]:
+    low, high = bounds[:, 0], bounds[:, 1]
+    size = len(low)
+
+    population = low + rng.random((popsize, size)) * (high - low)
+    errors = objective(population)
+
+    best = int(numpy.argmin(errors))
+    if callback is not None:
+        callback(0, population[best], errors[best])
+
+    others = numpy.array([[j for j in range(popsize) if j != i] for i in range(popsize)])
+    for generation in range(1, generations + 1):
+        # Three distinct members other than itself for every member.
+        picks = numpy.array([rng.choice(x, 3, replace = False) for x in others])
+        mutants = population[picks[:, 0]] + mutation * (population[picks[:, 1]] - population[picks[:, 2]])
+
+        # Mutants outside the bounds are moved halfway between their parent and the bound they crossed.
+        mutants = numpy.where(mutants < low, (population + low) / 2, mutants)
+        mutants = numpy.where(mutants > high, (population + high) / 2, mutants)
+
+        cross = rng.random((popsize, size)) < crossover
+        cross[numpy.arange(popsize), rng.integers(size, size = popsize)] = True
+        candidates = numpy.where(cross, mutants, population)
+
+        candidate_errors = objective(candidates)
+        better = candidate_errors <= errors
+        population[better] = candidates[better]
+        errors[better] = candidate_errors[better]
+
+        best = int(numpy.argmin(errors))
+        if callback is not None:
+            callback(generation, population[best], errors[best])
+
+        if numpy.isfinite(errors).all() and errors.max() - errors.min() <= tol * (1 + abs(errors.min())):
+            break
+
+    return population[best], float(errors[best])
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description = 'Fit the parameters of a model to observed learning curves',
+        epilog = 'Parameters to fit are NAME or NAME=LOW:HIGH, where NAME is one of alpha, beta, beta_neg, lamda, gamma, thetaE or thetaI, or alpha_X for the alpha of CS X. Observations are a CSV file with columns group, phase, cue, trial and the response, with phases counted from 1 and trials from 0, like the files written by --output.',
+    )
+
+    parser.add_argument('experiment_file', help = 'Path to the experiment file')
+    parser.add_argument('observations', help = 'CSV file with the observed responses')
+    parser.add_argument('--adaptive-type', choices = ADAPTIVE_TYPES, default = 'dualV', help = 'Adaptive type to fit')
+    parser.add_argument('--fit', nargs = '+', required = True, help = 'Parameters to fit, with their bounds')
+    parser.add_argument('--set', nargs = '*', default = [], help = 'Values of the parameters that are not fitted, instead of the defaults')
+    parser.add_argument('--column', default = 'response', help = 'Column of the observations with the responses')
+    parser.add_argument('--error', choices = list(ERRORS), default = 'sse', help = 'Error to minimise: sum of squared errors, or negative log-likelihood of responses between 0 and 1')
+    parser.add_argument('--popsize', type = int, default = 20, help = 'Number of candidates in every generation')
+    parser.add_argument('--generations', type = int, default = 100, help = 'Maximum number of generations')
+    parser.add_argument('--num-trials', type = int, default = 100, help = 'Amount of trials done in randomised phases')
+    parser.add_argument('--seed', type = int, default = 0, help = 'Seed for randomised phases and for the optimiser')
+    parser.add_argument('--output', help = 'JSON file in which to write the best parameters and the trace of the fit')
+
+    args = parser.parse_args()
+
+    points = parse_grid(args.set)
+    if len(points) != 1:
+        parser.error('--set takes a single value per parameter')
+    args.point = points[0]
+
+    try:
+        args.bounds = parse_bounds(args.fit)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.popsize < 4:
+        parser.error('--popsize must be at least 4')
+
+    return args
+
+def main():
+    opts = parse_args()
+
+    args = point_args(opts.point | {'adaptive_type': opts.adaptive_type, 'num_trials': opts.num_trials}, opts.seed)
+    names = list(opts.bounds)
+    bounds = numpy.array([opts.bounds[x] for x in names])
+
+    objective = Objective(read_design(opts.experiment_file), read_observations(opts.observations, opts.column), args, names, opts.error)
+
+    start = time.perf_counter()
+    trace = []
+    def callback(generation : int, point : numpy.ndarray, error : float):
+        params = {name: float(x) for name, x in zip(names, point)}
+        trace.append({'generation': generation, 'error': error, 'params': params, 'time': time.perf_counter() - start})
+        print(f'{generation:>4}: {opts.error} {error:.6g}  ' + '  '.join(f'{k}={v:.4f}' for k, v in params.items()), file = sys.stderr)
+
+    point, error = differential_evolution(objective, bounds, opts.popsize, opts.generations, numpy.random.default_rng(opts.seed), callback = callback)
+    elapsed = time.perf_counter() - start
+
+    params = {name: float(x) for name, x in zip(names, point)}
+    for name, value in params.items():
+        print(f'{name} = {value}')
+    print(f'{opts.error} = {error}')
+    print(f'{objective.evaluations} evaluations in {len(trace) - 1} generations, {elapsed:.2f}s', file = sys.stderr)
+
+    if opts.output is not None:
+        data = {
+            'adaptive_type': opts.adaptive_type,
+            'error_function': opts.error,
+            'params': params,
+            'error': error,
+            'evaluations': objective.evaluations,
+            'time': elapsed,
+            'trace': trace,
+        }
+        with open(opts.output, 'w') as file:
+            json.dump(data, file, indent = 2)
+
+if __name__ == '__main__':
+    main()
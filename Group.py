@@ -1,6 +1,17 @@
+import copy
 import math
-from itertools import combinations
+from collections import deque
+from collections.abc import Callable
+from itertools import combinations, groupby
+
+import numpy
+
 from Strengths import Strengths, History, Individual
+from Kernels import bind
+
+# runUntilSteady compares every trial of the first STEADY_WARMUP of a run, and then only every STEADY_STRIDE trials.
+STEADY_WARMUP = 100
+STEADY_STRIDE = 50
 
 def sigmoid(x):
   return 1 / (1 + math.exp(-x))
@@ -23,7 +34,18 @@ class Group:
     window_size : None | int
     xi_hall : None | float
 
-    def __init__(self, name : str, alphas : dict[str, float], default_alpha : float, default_alpha_mack: None | float, default_alpha_hall: None | float, betan : float, betap : float, lamda : float, gamma : float, thetaE : float, thetaI : float, cs : None | set[str] = None, use_configurals : bool = False, adaptive_type : None | str = None, window_size : None | int = None, xi_hall : None | float = None):
+    # The update of the adaptive type, with the parameters of the group bound to it.
+    kernel : Callable
+
+    # Whether runs of identical trials are computed in closed form when the model allows it.
+    # The results are equal to stepping up to rounding.
+    fast_forward : bool
+
+    # If set, a run of identical trials stops being stepped once a trial changes the state of its CSs
+    # by at most this much, and the rest of the run repeats that state. With 0 the results are exact.
+    steady_tolerance : None | float
+
+    def __init__(self, name : str, alphas : dict[str, float], default_alpha : float, default_alpha_mack: None | float, default_alpha_hall: None | float, betan : float, betap : float, lamda : float, gamma : float, thetaE : float, thetaI : float, cs : None | set[str] = None, use_configurals : bool = False, adaptive_type : None | str = None, window_size : None | int = None, xi_hall : None | float = None, fast_forward : bool = False, steady_tolerance : None | float = None):
         if cs is not None:
             alphas = {k: alphas.get(k, default_alpha) for k in cs | alphas.keys()}
 
@@ -48,8 +70,11 @@ class Group:
         self.use_configurals = use_configurals
         self.adaptive_type = adaptive_type
         self.window_size = window_size
+        self.fast_forward = fast_forward
+        self.steady_tolerance = steady_tolerance
 
         self.prev_lamda = lamda
+        self.kernel = bind(self)
 
         # For simplicity, if we use_configurals and some compound stimuli don't
         # have a corresponding \alpha, then we calculate it as the product
@@ -96,20 +121,28 @@ class Group:
         return new_error
 
     # compounds should probably be moved to Strengths.
-    def compounds(self, part : str) -> set[str]:
+    # They are sorted, rather than in set order, so that sums over them are done in the
+    # same order in every process regardless of its hash seed.
+    def compounds(self, part : str) -> list[str]:
         compounds = set(part)
         if self.use_configurals:
             compounds.add(part)
 
-        return compounds
+        return sorted(compounds)
 
-    # runPhase runs a single trial of a phase, in order, and returns a list of the Strength values
-    # of its CS at every step.
+    # runPhase runs a single trial of a phase, in order, and returns the History of each of its CS.
     # It also modifies `self.s` to account for all the strengths modified in this phase.
-    def runPhase(self, parts : list[tuple[str, str]], phase_lamda : None | float) -> list[Strengths]:
+    # With `reference`, every CS is updated by `step` rather than by the kernel, which gives the same results.
+    def runPhase(self, parts : list[tuple[str, str]], phase_lamda : None | float, reference : bool = False) -> dict[str, History]:
+        runs = [(part, plus, sum(1 for _ in trials)) for (part, plus), trials in groupby(parts)]
+        return self.runRuns(runs, phase_lamda, reference = reference)
+
+    # runRuns is runPhase for a phase given as runs of (part, plus, count) identical trials.
+    # The compounds, beta and lamda of a run, and the strengths of its CSs, are only looked up once.
+    def runRuns(self, runs : list[tuple[str, str, int]], phase_lamda : None | float, reference : bool = False) -> dict[str, History]:
         hist = dict()
 
-        for part, plus in parts:
+        for part, plus, count in runs:
             if plus == '+':
                 beta, lamda, sign = self.betap, phase_lamda or self.lamda, 1
             else:
@@ -117,32 +150,320 @@ class Group:
 
             compounds = self.compounds(part)
 
-            sigma = sum(self.s[x].assoc for x in compounds)
-            sigmaE = sum(self.s[x].Ve for x in compounds)
-            sigmaI = sum(self.s[x].Vi for x in compounds)
+            # Compound CSs are built anew on every lookup, so they need the generic path.
+            if reference or any(len(cs) > 1 for cs in compounds):
+                for _ in range(count):
+                    self.runTrial(hist, compounds, beta, lamda, sign, reference)
+                continue
+
+            strengths = [self.s[cs] for cs in compounds]
 
-            for cs in compounds:
+            # A CS isn't modified before its own update, so its first record can be taken at the start of the run.
+            for cs, s in zip(compounds, strengths):
                 if cs not in hist:
                     hist[cs] = History()
-                    hist[cs].add(self.s[cs])
+                    hist[cs].add(s)
+
+            records = [hist[cs] for cs in compounds]
+
+            # The first trial of a run can have a different prev_lamda, so it's always stepped.
+            factor = self.alphaFactor(sign) if self.fast_forward and count > 1 else None
+            if factor is None and self.steady_tolerance is not None:
+                self.runUntilSteady(strengths, records, beta, lamda, sign, count)
+                continue
+
+            for _ in range(count if factor is None else 1):
+                sigma = sum(s.assoc for s in strengths)
+                sigmaE = sum(s.Ve for s in strengths)
+                sigmaI = sum(s.Vi for s in strengths)
+
+                for s, record in zip(strengths, records):
+                    self.update(s, beta, lamda, sign, sigma, sigmaE, sigmaI)
+                    record.add(s)
+
+                self.prev_lamda = lamda
+
+            if factor is not None:
+                self.fastForward(strengths, records, beta, lamda, sign, factor, count - 1)
+
+        return hist
+
+    # runUntilSteady steps a run of trials until one leaves the state of its CSs unchanged, to within
+    # steady_tolerance, and then records that state for the rest of the run.
+    # The first trial isn't compared, as its prev_lamda can differ from the rest.
+    # Runs that settle mostly do so early, and comparing costs about as much as a trial, so after the first
+    # STEADY_WARMUP trials the state is only compared over a few trials in a row every STEADY_STRIDE. That bounds
+    # the cost of runs that never settle, such as those that oscillate, diverge or only converge slowly.
+    def runUntilSteady(self, strengths : list[Individual], records : list[History], beta : float, lamda : float, sign : int, count : int):
+        assert self.steady_tolerance is not None
+        tolerance = self.steady_tolerance
+
+        # The whole state is only compared once assoc has settled, which is much cheaper to check.
+        assocs = None
+        previous = None
+        for n in range(count):
+            sigma = sum(s.assoc for s in strengths)
+            sigmaE = sum(s.Ve for s in strengths)
+            sigmaI = sum(s.Vi for s in strengths)
+
+            for s, record in zip(strengths, records):
+                self.update(s, beta, lamda, sign, sigma, sigmaE, sigmaI)
+                record.add(s)
 
-                self.step(cs, beta, lamda, sign, sigma, sigmaE, sigmaI)
+            self.prev_lamda = lamda
 
-                if self.window_size is not None:
-                    if len(self.s[cs].window) >= self.window_size:
-                        self.s[cs].window.popleft()
+            # Three trials in a row are needed: one to compare assoc against, one to take the state of, and one to
+            # compare it against.
+            if n >= STEADY_WARMUP and n % STEADY_STRIDE >= 3:
+                assocs = None
+                previous = None
+                continue
+
+            settled = assocs is not None and all(abs(s.assoc - a) <= tolerance for s, a in zip(strengths, assocs))
+            assocs = [s.assoc for s in strengths]
+            if not settled:
+                previous = None
+                continue
+
+            state = [x for s in strengths for x in (s.assoc, s.Ve, s.Vi, s.alpha, s.alpha_mack, s.alpha_hall, s.delta_ma_hall, *s.window)]
+            if previous is not None and len(state) == len(previous) and all(abs(a - b) <= tolerance for a, b in zip(state, previous)):
+                for s, record in zip(strengths, records):
+                    record.extend(s, {'assoc': numpy.full(count - n - 1, s.assoc)})
+                return
+
+            previous = state
+
+    # alphaFactor returns the factor by which the kernel multiplies alpha in every trial with this sign, for
+    # models in which, apart from that, a trial is the plain Rescorla-Wagner update of assoc.
+    # For other models it returns None, and runs are stepped.
+    def alphaFactor(self, sign : int) -> None | float:
+        if self.window_size is not None:
+            return None
 
-                    self.s[cs].window.append(self.s[cs].assoc)
-                    window_avg = sum(self.s[cs].window) / len(self.s[cs].window)
+        match self.adaptive_type:
+            case 'linear':
+                return 1 + sign * 0.05
+            case 'exponential' if sign != 1:
+                return 1.
+
+        return None
+
+    # fastForward runs `count` identical trials at once, after the first one of their run.
+    # With alpha_i(n) the alpha of CS i on trial n and A(n) their sum, the error E = lamda - sigma follows
+    # E(n) = E(n - 1) * (1 - beta * A(n)), and every CS gains alpha_i(n) * beta * E(n - 1) on trial n.
+    # Once beta * A(n) reaches 1 that product stops shrinking rounding errors, which stepping doesn't have, so the
+    # trials from there are stepped until the error is exactly 0, after which they only grow alpha.
+    def fastForward(self, strengths : list[Individual], records : list[History], beta : float, lamda : float, sign : int, factor : float, count : int):
+        with numpy.errstate(over = 'ignore'):
+            alphas = [numpy.cumprod(numpy.concatenate([[s.alpha], numpy.full(count, factor)]))[1:] for s in strengths]
+            total = beta * sum(alphas)
+
+        unstable = total >= 1
+        closed = int(numpy.argmax(unstable)) if unstable.any() else count
+        if closed > 0:
+            error = lamda - sum(s.assoc for s in strengths)
+            errors = error * numpy.concatenate([[1.], numpy.cumprod(1 - total[:closed - 1])])
+
+            for s, record, alpha in zip(strengths, records, alphas):
+                assoc = s.assoc + numpy.cumsum(alpha[:closed] * beta * errors)
+                record.extend(s, {'assoc': assoc, 'alpha': alpha[:closed]})
+
+                s.assoc = float(assoc[-1])
+                s.alpha = float(alpha[closed - 1])
 
-                    # delta_ma_hall is modified using the previous associated value.
-                    self.s[cs].delta_ma_hall = window_avg - hist[cs].assoc[-1]
+        self.prev_lamda = lamda
 
-                hist[cs].add(self.s[cs])
-            self.prev_lamda = lamda
+        done = closed
+        while done < count and lamda - sum(s.assoc for s in strengths) != 0:
+            sigma = sum(s.assoc for s in strengths)
+            sigmaE = sum(s.Ve for s in strengths)
+            sigmaI = sum(s.Vi for s in strengths)
+
+            for s, record in zip(strengths, records):
+                self.update(s, beta, lamda, sign, sigma, sigmaE, sigmaI)
+                record.add(s)
+
+            done += 1
+
+        if done == count:
+            return
+
+        # Without an error, assoc stays the same until alpha overflows, and inf * 0 makes it nan; the other CSs
+        # become nan on the trial after.
+        alphas = [alpha[done:] for alpha in alphas]
+        overflows = [int(numpy.argmax(numpy.isinf(alpha))) if numpy.isinf(alpha[-1]) else len(alpha) for alpha in alphas]
+        first = min(overflows)
+        for s, record, alpha, overflow in zip(strengths, records, alphas, overflows):
+            assoc = numpy.full(len(alpha), s.assoc)
+            assoc[min(overflow, first + 1):] = numpy.nan
+            record.extend(s, {'assoc': assoc, 'alpha': alpha})
+
+            s.assoc = float(assoc[-1])
+            s.alpha = float(alpha[-1])
+
+    # runExpected runs a randomised phase, given as runs, a single time in expectation rather than shuffled:
+    # at every position, the state of every CS becomes the average of its states after each trial type, weighted
+    # by the share of the remaining trials of that type, which in expectation stays its share of the phase.
+    # Since the update depends on the lamda of the previous trial, a separate average is kept for each value
+    # it can take, weighted by how likely it is, and the expected lamda is left for the next phase.
+    # The History of a CS records its state after its j-th presentation as its expected state at the position by
+    # which it has been presented j times on average, interpolated between positions.
+    # Like every replicate, it starts from a copy of the strengths, and it leaves their average at the end.
+    def runExpected(self, runs : list[tuple[str, str, int]], phase_lamda : None | float) -> dict[str, History]:
+        counts = {}
+        for part, plus, count in runs:
+            counts[part, plus] = counts.get((part, plus), 0) + count
+
+        types = sorted(counts)
+        compounds = [self.compounds(part) for part, _ in types]
+        if any(len(cs) > 1 for x in compounds for cs in x):
+            raise ValueError('Configural cues are not supported in expectation')
+
+        total = sum(counts.values())
+        remaining = [float(counts[x]) for x in types]
+        names = sorted({cs for x in compounds for cs in x})
+
+        start = Strengths(s = {k: v.copy() for k, v in self.s.s.items()})
+        fields = {cs: {prop: [getattr(start[cs], prop)] for prop in History.FIELDS} for cs in names}
+
+        # prev_lamda -> (probability, expected state of every CS given it).
+        # Replicates start from the lamda of the last trial of the one before, which is that of each trial type
+        # as often as its share of the phase.
+        states = {}
+        for (_, plus), count in counts.items():
+            lamda = phase_lamda or self.lamda if plus == '+' else 0.
+            prob = states.get(lamda, (0., None))[0] + count / total
+            states[lamda] = (prob, {cs: start[cs] for cs in names})
+
+        for t in range(total):
+            weights = [x / (total - t) for x in remaining]
+
+            outcomes = {}
+            for prev_lamda, (prob, state) in states.items():
+                self.prev_lamda = prev_lamda
+                for (part, plus), members, weight in zip(types, compounds, weights):
+                    if plus == '+':
+                        beta, lamda, sign = self.betap, phase_lamda or self.lamda, 1
+                    else:
+                        beta, lamda, sign = self.betan, 0., -1
+
+                    # Copies that keep Ve and Vi, unlike Individual.copy.
+                    strengths = dict(state)
+                    for cs in members:
+                        strengths[cs] = copy.copy(state[cs])
+                        strengths[cs].window = deque(state[cs].window)
+
+                    sigma = sum(strengths[cs].assoc for cs in members)
+                    sigmaE = sum(strengths[cs].Ve for cs in members)
+                    sigmaI = sum(strengths[cs].Vi for cs in members)
+
+                    for cs in members:
+                        self.update(strengths[cs], beta, lamda, sign, sigma, sigmaE, sigmaI)
+
+                    outcomes.setdefault(lamda, []).append((prob * weight, strengths))
+
+            states = {lamda: (sum(w for w, _ in x), self.mixStates(x)) for lamda, x in outcomes.items() if sum(w for w, _ in x) > 0}
+            expected = self.mixStates(list(states.values()))
+            for cs in names:
+                for prop in History.FIELDS:
+                    fields[cs][prop].append(getattr(expected[cs], prop))
+
+            remaining = [x - w for x, w in zip(remaining, weights)]
+
+        hist = dict()
+        positions = numpy.arange(total + 1)
+        for cs in names:
+            presentations = sum(counts[x] for x, members in zip(types, compounds) if cs in members)
+            steps = numpy.arange(presentations + 1) * total / presentations
+
+            hist[cs] = History()
+            hist[cs].extend(expected[cs], {prop: numpy.interp(steps, positions, values) for prop, values in fields[cs].items()})
+
+        self.prev_lamda = sum(prob * lamda for lamda, (prob, _) in states.items())
+        self.s = Strengths(s = {k: expected[k].copy() if k in expected else v.copy() for k, v in start.s.items()})
+
+        return hist
+
+    # mixStates returns the average of several states of the same CSs, given with their weights.
+    # Windows of different lengths are aligned on their last value, as in Individual.join.
+    @staticmethod
+    def mixStates(states : list[tuple[float, dict[str, Individual]]]) -> dict[str, Individual]:
+        total = sum(w for w, _ in states)
+
+        ret = {}
+        for cs in states[0][1]:
+            ind = copy.copy(states[0][1][cs])
+            for prop in History.FIELDS:
+                setattr(ind, prop, sum(w * getattr(x[cs], prop) for w, x in states) / total)
+
+            size = max(len(x[cs].window) for _, x in states)
+            window = [0.] * size
+            for w, x in states:
+                for e, value in enumerate(x[cs].window, start = size - len(x[cs].window)):
+                    window[e] += w * value / total
+            ind.window = deque(window)
+
+            ret[cs] = ind
+
+        return ret
+
+    # runTrial runs a single trial, looking up every CS as it goes.
+    def runTrial(self, hist : dict[str, History], compounds : list[str], beta : float, lamda : float, sign : int, reference : bool):
+        sigma = sum(self.s[x].assoc for x in compounds)
+        sigmaE = sum(self.s[x].Ve for x in compounds)
+        sigmaI = sum(self.s[x].Vi for x in compounds)
+
+        for cs in compounds:
+            if reference or len(cs) > 1:
+                self.stepGeneric(hist, cs, beta, lamda, sign, sigma, sigmaE, sigmaI)
+                continue
+
+            s = self.s[cs]
+            if cs not in hist:
+                hist[cs] = History()
+                hist[cs].add(s)
+
+            self.update(s, beta, lamda, sign, sigma, sigmaE, sigmaI)
+            hist[cs].add(s)
+
+        self.prev_lamda = lamda
+
+    # update applies the kernel to the strengths of a single CS, and then moves its window.
+    def update(self, s : Individual, beta : float, lamda : float, sign : int, sigma : float, sigmaE : float, sigmaI : float):
+        prev_assoc = s.assoc
+        self.kernel(s, beta, lamda, sign, sigma, sigmaE, sigmaI, self.prev_lamda)
+
+        if self.window_size is not None:
+            if len(s.window) >= self.window_size:
+                s.window.popleft()
+
+            s.window.append(s.assoc)
+            window_avg = sum(s.window) / len(s.window)
+
+            # delta_ma_hall is modified using the previous associated value.
+            s.delta_ma_hall = window_avg - prev_assoc
+
+    def stepGeneric(self, hist : dict[str, History], cs : str, beta : float, lamda : float, sign : int, sigma : float, sigmaE : float, sigmaI : float):
+        if cs not in hist:
+            hist[cs] = History()
+            hist[cs].add(self.s[cs])
+
+        prev_assoc = self.s[cs].assoc
+        self.step(cs, beta, lamda, sign, sigma, sigmaE, sigmaI)
+
+        if self.window_size is not None:
+            if len(self.s[cs].window) >= self.window_size:
+                self.s[cs].window.popleft()
+
+            self.s[cs].window.append(self.s[cs].assoc)
+            window_avg = sum(self.s[cs].window) / len(self.s[cs].window)
+
+            # delta_ma_hall is modified using the previous associated value.
+            self.s[cs].delta_ma_hall = window_avg - prev_assoc
 
-        return Strengths.fromHistories(hist)
+        hist[cs].add(self.s[cs])
 
+    # step is the reference implementation of every adaptive type, which the kernels in Kernels.py follow.
     def step(self, cs: str, beta: float, lamda: float, sign: int, sigma: float, sigmaE: float, sigmaI: float):
         delta_v_factor = beta * (self.prev_lamda - sigma)
 
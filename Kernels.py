@@ -0,0 +1,168 @@
+import math
+from functools import partial
+
+# One update function per adaptive type, with the same operations, in the same order, as the
+# corresponding branch of Group.step.
+# Each kernel takes the parameters of the group listed in PARAMS, followed by the Individual of a
+# single CS and the values of the trial. The parameters are bound once by `bind`, so a step
+# only does the work of its own model.
+def linear(s, beta, lamda, sign, sigma, sigmaE, sigmaI, prev_lamda):
+    delta_v_factor = beta * (prev_lamda - sigma)
+    s.alpha *= 1 + sign * 0.05
+    s.assoc += s.alpha * delta_v_factor
+
+def exponential(s, beta, lamda, sign, sigma, sigmaE, sigmaI, prev_lamda):
+    delta_v_factor = beta * (prev_lamda - sigma)
+    if sign == 1:
+        s.alpha *= (s.alpha ** 0.05) ** sign
+    s.assoc += s.alpha * delta_v_factor
+
+def mack(s, beta, lamda, sign, sigma, sigmaE, sigmaI, prev_lamda):
+    delta_v_factor = beta * (prev_lamda - sigma)
+    s.alpha_mack = 1/2 * (1 + 2*s.assoc - sigma)
+    s.alpha = s.alpha_mack
+    s.assoc = s.assoc * delta_v_factor + delta_v_factor/2*beta
+
+def alpha_hall(xi_hall, s, sigma, lamda):
+    assert xi_hall is not None
+
+    surprise = abs(lamda - sigma)
+    gamma = 0.99
+    return gamma*surprise + (1-gamma)*s.alpha_hall
+
+def hall(xi_hall, s, beta, lamda, sign, sigma, sigmaE, sigmaI, prev_lamda):
+    s.alpha_hall = alpha_hall(xi_hall, s, sigma, prev_lamda)
+    s.alpha = s.alpha_hall
+    s.assoc += s.alpha * beta * (lamda - sigma)
+
+def macknhall(xi_hall, s, beta, lamda, sign, sigma, sigmaE, sigmaI, prev_lamda):
+    delta_v_factor = beta * (prev_lamda - sigma)
+    s.alpha_mack = 1/2 * (1 + 2*s.assoc - sigma)
+    s.alpha_hall = alpha_hall(xi_hall, s, sigma, prev_lamda)
+    s.alpha = (1 - abs(prev_lamda - sigma)) * s.alpha_mack + s.alpha_hall
+    s.assoc += s.alpha * delta_v_factor
+
+def dualV(betap, betan, gamma, s, beta, lamda, sign, sigma, sigmaE, sigmaI, prev_lamda):
+    rho = lamda - (sigmaE - sigmaI)
+
+    if rho >= 0:
+        s.Ve += betap * s.alpha * lamda
+    else:
+        s.Vi += betan * s.alpha * abs(rho)
+
+    s.alpha = gamma * abs(rho) + (1 - gamma) * s.alpha
+    s.assoc = s.Ve - s.Vi
+
+def newDualV(betap, betan, s, beta, lamda, sign, sigma, sigmaE, sigmaI, prev_lamda):
+    rho = lamda - (sigmaE - sigmaI)
+
+    delta_ma_hall = s.delta_ma_hall or 0
+    gamma = 1 - math.exp(-delta_ma_hall**2)
+
+    if rho >= 0:
+        s.Ve += betap * s.alpha * lamda
+    else:
+        s.Vi += betan * s.alpha * abs(rho)
+
+    s.alpha = gamma * abs(rho) + (1 - gamma) * s.alpha
+    s.assoc = s.Ve - s.Vi
+
+def lepelley(betap, betan, thetaE, thetaI, s, beta, lamda, sign, sigma, sigmaE, sigmaI, prev_lamda):
+    rho = lamda - (sigmaE - sigmaI)
+
+    VXe = sigmaE - s.Ve
+    VXi = sigmaI - s.Vi
+
+    DVe = 0.
+    DVi = 0.
+    if rho >= 0:
+        DVe = s.alpha * betap * (1 - s.Ve + s.Vi) * abs(rho)
+
+        if rho > 0:
+            s.alpha += -thetaE * (abs(lamda - s.Ve + s.Vi) - abs(lamda - VXe + VXi))
+    else:
+        DVi = s.alpha * betan * (1 - s.Vi + s.Ve) * abs(rho)
+        s.alpha += -thetaI * (abs(abs(rho) - s.Vi + s.Ve) - abs(abs(rho) - VXi + VXe))
+
+    s.alpha = min(max(s.alpha, 0.05), 1)
+    s.Ve += DVe
+    s.Vi += DVi
+
+    s.assoc = s.Ve - s.Vi
+
+def dualmack(betap, betan, s, beta, lamda, sign, sigma, sigmaE, sigmaI, prev_lamda):
+    rho = lamda - (sigmaE - sigmaI)
+
+    VXe = sigmaE - s.Ve
+    VXi = sigmaI - s.Vi
+
+    if rho >= 0:
+        s.Ve += s.alpha * betap * (1 - s.Ve + s.Vi) * abs(rho)
+    else:
+        s.Vi += s.alpha * betan * (1 - s.Vi + s.Ve) * abs(rho)
+
+    s.alpha = 1/2 * (1 + s.assoc - (VXe - VXi))
+    s.assoc = s.Ve - s.Vi
+
+def hybrid(betap, betan, gamma, thetaE, thetaI, s, beta, lamda, sign, sigma, sigmaE, sigmaI, prev_lamda):
+    rho = lamda - (sigmaE - sigmaI)
+
+    if rho >= 0:
+        NVe = s.Ve + s.alpha_hall * betap * (1 - s.Ve + s.Vi) * abs(rho)
+        NVi = s.Vi
+    else:
+        NVe = s.Ve
+        NVi = s.Vi + s.alpha_hall * betan * (1 - s.Vi + s.Ve) * abs(rho)
+
+    VXe = sigmaE - s.Ve
+    VXi = sigmaI - s.Vi
+    if rho > 0:
+        s.alpha_mack += -thetaE * (abs(lamda - s.Ve + s.Vi) - abs(lamda - VXe + VXi))
+    elif rho < 0:
+        s.alpha_mack += -thetaI * (abs(abs(rho) - s.Vi + s.Ve) - abs(abs(rho) - VXi + VXe))
+
+    s.alpha_mack = min(max(s.alpha_mack, 0.05), 1)
+    s.alpha_hall = gamma * abs(rho) + (1 - gamma) * s.alpha_hall
+
+    s.Ve = NVe
+    s.Vi = NVi
+
+    s.assoc = s.alpha_mack * (s.Ve - s.Vi)
+
+KERNELS = {
+    'linear': linear,
+    'exponential': exponential,
+    'mack': mack,
+    'hall': hall,
+    'macknhall': macknhall,
+    'dualV': dualV,
+    'newDualV': newDualV,
+    'lepelley': lepelley,
+    'dualmack': dualmack,
+    'hybrid': hybrid,
+}
+
+# Attributes of the Group that each kernel takes before the Individual.
+PARAMS = {
+    'linear': (),
+    'exponential': (),
+    'mack': (),
+    'hall': ('xi_hall',),
+    'macknhall': ('xi_hall',),
+    'dualV': ('betap', 'betan', 'gamma'),
+    'newDualV': ('betap', 'betan'),
+    'lepelley': ('betap', 'betan', 'thetaE', 'thetaI'),
+    'dualmack': ('betap', 'betan'),
+    'hybrid': ('betap', 'betan', 'gamma', 'thetaE', 'thetaI'),
+}
+
+def unknown(adaptive_type, *args):
+    raise NameError(f'Unknown adaptive type {adaptive_type}!')
+
+# bind returns the kernel of the group's adaptive type with its parameters already applied.
+# Partials, unlike closures, can be pickled and deep-copied along with the group.
+def bind(g) -> partial:
+    if g.adaptive_type not in KERNELS:
+        return partial(unknown, g.adaptive_type)
+
+    return partial(KERNELS[g.adaptive_type], *[getattr(g, x) for x in PARAMS[g.adaptive_type]])
@@ -1,7 +1,7 @@
 import re
+import numpy
 import seaborn
 import matplotlib
-matplotlib.use('QtAgg')
 
 from matplotlib import pyplot
 from Strengths import History
@@ -56,6 +56,11 @@ def generate_figures(data: list[dict[str, History]], *, phases: None | dict[str,
         for key, hist in experiments.items():
             axes[0].plot(hist.assoc, label=key, marker='D', color = colors[key], markersize=4, alpha=.5)
 
+            # Randomised phases can carry the standard error of each step.
+            if not numpy.isnan(hist.se).all():
+                se = numpy.nan_to_num(hist.se)
+                axes[0].fill_between(numpy.arange(len(se)), hist.assoc - se, hist.assoc + se, color = colors[key], alpha = .2, linewidth = 0)
+
             if len(axes) > 1:
                 if plot_alpha:
                     axes[1].plot(hist.alpha, label=key, color = colors[key], marker='D', markersize=8, alpha=.5)
@@ -94,6 +99,8 @@ def generate_figures(data: list[dict[str, History]], *, phases: None | dict[str,
     return figures
 
 def show_plots(data: list[dict[str, History]], *, phases: None | dict[str, list[Phase]] = None, plot_phase = None, plot_alpha = False, plot_macknhall = False):
+    # The interactive backend is only loaded when figures are shown.
+    matplotlib.use('QtAgg')
     pyplot.ion()
 
     figures = generate_figures(
@@ -124,3 +131,4 @@ def save_plots(data: list[dict[str, History]], *, phases: None | dict[str, list[
 
     for phase_num, fig in enumerate(figures, start = 1):
         fig.savefig(f'{filename}_{phase_num}.png', dpi = 150, bbox_inches = 'tight')
+        pyplot.close(fig)
@@ -0,0 +1,145 @@
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+from Strengths import Individual, Strengths, History
+
+# Classes whose constructions are counted while profiling.
+ALLOCATED = (Individual, Strengths, History)
+
+# Profiler collects the time spent in each stage of a run, along with counters, keyed by the stage and
+# the group, phase and model it was in.
+# The code being profiled only calls `stage` and `count` around whole phases, replicates or groups,
+# which do nothing unless a profiler is active, so there is no cost per trial when profiling is off.
+class Profiler:
+    # (stage, group, phase, model) -> seconds, calls, and every counter.
+    times : dict[tuple, float]
+    calls : dict[tuple, int]
+    counters : dict[tuple, dict[str, int]]
+
+    # Labels of the stages currently running, innermost last.
+    stack : list[tuple]
+
+    def __init__(self):
+        self.times = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(lambda: defaultdict(int))
+        self.stack = []
+        self.originals = {}
+
+    @contextmanager
+    def stage(self, name : str, group : None | str = None, phase : None | int = None, model : None | str = None):
+        key = (name, group, phase, model)
+        self.stack.append(key)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stack.pop()
+
+            self.times[key] += elapsed
+            self.calls[key] += 1
+
+            # Time of nested stages is only counted in the innermost one.
+            if self.stack:
+                self.times[self.stack[-1]] -= elapsed
+
+    def count(self, counter : str, n : int = 1):
+        key = self.stack[-1] if self.stack else ('other', None, None, None)
+        self.counters[key][counter] += n
+
+    # install counts the objects of every class in ALLOCATED that are constructed, by wrapping their
+    # __init__ until uninstall is called.
+    def install(self):
+        for cls in ALLOCATED:
+            self.originals[cls] = cls.__init__
+            cls.__init__ = self.counted(cls.__init__, cls.__name__)
+
+    def counted(self, init, name : str):
+        def wrapper(obj, *args, **kwargs):
+            self.count(name)
+            init(obj, *args, **kwargs)
+
+        return wrapper
+
+    def uninstall(self):
+        for cls, init in self.originals.items():
+            cls.__init__ = init
+        self.originals = {}
+
+    def rows(self) -> list[dict]:
+        ret = []
+        for key in sorted(self.times.keys() | self.counters.keys(), key = lambda x: tuple('' if y is None else str(y) for y in x)):
+            name, group, phase, model = key
+            ret.append({
+                'stage': name,
+                'group': group,
+                'phase': phase,
+                'model': model,
+                'time': self.times.get(key, 0.),
+                'calls': self.calls.get(key, 0),
+            } | dict(self.counters.get(key, {})))
+
+        return ret
+
+    def summary(self) -> str:
+        rows = self.rows()
+        counters = sorted({k for row in rows for k in row.keys()} - {'stage', 'group', 'phase', 'model', 'time', 'calls'})
+
+        header = ['stage', 'group', 'phase', 'model', 'time (s)', 'calls', 'µs/trial'] + counters
+        table = [header]
+        for row in rows:
+            per_trial = ''
+            if row.get('trials'):
+                per_trial = f'{row["time"] / row["trials"] * 1e6:.2f}'
+
+            table.append([
+                row['stage'],
+                row['group'] or '',
+                '' if row['phase'] is None else str(row['phase']),
+                row['model'] or '',
+                f'{row["time"]:.4f}',
+                str(row['calls']),
+                per_trial,
+            ] + [str(row.get(k, '')) for k in counters])
+
+        total = sum(row['time'] for row in rows)
+        widths = [max(len(x[e]) for x in table) for e in range(len(header))]
+        lines = ['  '.join(x.ljust(w) for x, w in zip(line, widths)) for line in table]
+        lines.append(f'Total: {total:.4f}s')
+
+        return '\n'.join(lines)
+
+    def write(self, filename : str):
+        with open(filename, 'w') as file:
+            json.dump({'rows': self.rows()}, file, indent = 2)
+
+# The profiler of the current process, if profiling.
+active : None | Profiler = None
+
+def start() -> Profiler:
+    global active
+    active = Profiler()
+    active.install()
+    return active
+
+def stop() -> None | Profiler:
+    global active
+    ret = active
+    if ret is not None:
+        ret.uninstall()
+
+    active = None
+    return ret
+
+def stage(name : str, group : None | str = None, phase : None | int = None, model : None | str = None):
+    if active is None:
+        return nullcontext()
+
+    return active.stage(name, group, phase, model)
+
+def count(counter : str, n : int = 1):
+    if active is not None:
+        active.count(counter, n)
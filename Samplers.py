@@ -0,0 +1,66 @@
+import random
+from collections.abc import Iterator
+
+# Samplers of the orders in which the trials of a randomised phase are run, for `n` replicates.
+# Each one yields blocks of orders, drawn from `rng`, which is the global `random` unless a stream of their own
+# is given. Every order on its own is a uniformly random permutation of the trials, so their average estimates
+# the same curves as independent shuffles, but the orders of a block are chosen together so that their average
+# varies less. Blocks are independent of each other, so the standard error is computed from the spread of their means.
+
+# shuffle yields independent orders, each in a block of its own. It shuffles `elems` in place, one shuffle
+# after another, which is how randomised phases have always been run.
+def shuffle(elems : list, n : int, rng = random) -> Iterator[list[list]]:
+    for _ in range(n):
+        rng.shuffle(elems)
+        yield [elems]
+
+# antithetic yields pairs of a random order and its reverse, so that trials that come early in one come late in the other.
+def antithetic(elems : list, n : int, rng = random) -> Iterator[list[list]]:
+    for r in range(0, n, 2):
+        rng.shuffle(elems)
+        yield [list(elems), elems[::-1]][:n - r]
+
+# latin_rows returns `rows` orders from a random Latin square of the trials, in which every trial takes every
+# position exactly once. The square is the cyclic one with its symbols (`elems`) and columns permuted at random,
+# and its rows are taken evenly spaced, from a random start.
+def latin_rows(elems : list, rows : int, rng = random) -> list[list]:
+    size = len(elems)
+    rng.shuffle(elems)
+
+    columns = list(range(size))
+    rng.shuffle(columns)
+    start = rng.random()
+
+    ret = []
+    for r in range(rows):
+        shift = int((r + start) * size / rows)
+
+        order = [None] * size
+        for e, x in enumerate(elems):
+            order[columns[(e + shift) % size]] = x
+        ret.append(order)
+
+    return ret
+
+# Number of orders in every block of `stratified`.
+STRATA = 10
+
+# stratified yields blocks of STRATA rows of random Latin squares, so that within a block every trial takes a
+# different position in every order, spread evenly over the phase.
+def stratified(elems : list, n : int, rng = random) -> Iterator[list[list]]:
+    rows = min(STRATA, len(elems))
+    for r in range(0, n, rows):
+        yield latin_rows(elems, min(rows, n - r), rng)
+
+# latin yields whole random Latin squares, with as many orders as the phase has trials. It's meant for small
+# phases, with at least twice as many replicates as trials so that there are blocks to estimate the error from.
+def latin(elems : list, n : int, rng = random) -> Iterator[list[list]]:
+    for r in range(0, n, len(elems)):
+        yield latin_rows(elems, min(len(elems), n - r), rng)
+
+SAMPLERS = {
+    'shuffle': shuffle,
+    'antithetic': antithetic,
+    'stratified': stratified,
+    'latin': latin,
+}
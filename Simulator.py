@@ -1,12 +1,17 @@
 import argparse
+import os
 import random
 import re
 import sys
 from collections import defaultdict
-from Experiment import run_all_phases
+from concurrent.futures import ProcessPoolExecutor
+from Cache import ResultCache
+from Experiment import Phase, run_all_groups
+from Export import WRITERS, write_data
+from Samplers import SAMPLERS
+import Profile
 from Group import Group
 from Strengths import Strengths, History
-from Plots import show_plots, save_plots
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
@@ -33,19 +38,42 @@ def parse_args() -> argparse.Namespace:
 
     parser.add_argument("--xi-hall", type = float, default = 0.2, help = 'Xi parameter for Hall alpha calculation')
 
+    parser.add_argument("--seed", type = int, help = 'Seed for randomised phases. Each group is seeded from this and its name')
+    parser.add_argument("--jobs", type = int, default = 1, help = 'Number of processes across which to run the groups. With --seed, the output is the same for any number of processes')
+    parser.add_argument("--share-prefixes", type = bool, action = argparse.BooleanOptionalAction, default = True, help = 'Run the leading phases that several groups have in common once for all of them, as long as they draw no random numbers. The output is the same either way')
+    parser.add_argument("--replicate-jobs", type = int, metavar = 'JOBS', help = 'Run the replicates of randomised phases in shards of 50, each with its own random numbers, spread across JOBS processes. Results are the same for any JOBS, but differ from those without this option. Groups are run one after another, so --jobs is ignored')
+
+    parser.add_argument("--cache-dir", type = str, help = 'Directory in which to keep the results of each group, which are reused when nothing that affects them has changed')
+    parser.add_argument("--cache-size", type = float, default = 512, help = 'Maximum size of the cache, in MiB. The least recently used results are removed first')
+    parser.add_argument("--cache-stats", type = bool, action = argparse.BooleanOptionalAction, default = False, help = 'Print cache statistics at the end')
+
+
     parser.add_argument("--num-trials", type = int, default = 1000, help = 'Amount of trials done in randomised phases')
+    parser.add_argument("--fast-forward", type = bool, action = argparse.BooleanOptionalAction, default = False, help = 'Compute runs of identical trials in closed form where the adaptive type allows it (linear, and unreinforced exponential). Equal to stepping up to rounding')
+    parser.add_argument("--steady-state", type = float, metavar = 'TOLERANCE', help = 'Stop stepping a run of identical trials once a trial changes every value by at most TOLERANCE, and repeat the last state for the rest of the run. With 0, results are exact')
+    parser.add_argument("--se-tolerance", type = float, metavar = 'TOLERANCE', help = 'Run the replicates of randomised phases in blocks until the standard error of the mean associative strength of every stimulus, at every trial, is at most TOLERANCE, with --num-trials as the maximum. The number of replicates run is printed')
+    parser.add_argument("--sampler", choices = list(SAMPLERS), default = 'shuffle', help = 'How to draw the orders of the replicates of randomised phases: independent shuffles, antithetic pairs of an order and its reverse, or rows of random Latin squares in blocks of 10 (stratified) or whole (latin, for small phases). Every sampler but shuffle prints its standard error')
+    parser.add_argument("--mean-field", type = bool, action = argparse.BooleanOptionalAction, default = False, help = 'Run randomised phases a single time in expectation, weighting every trial type by its share of the remaining trials, rather than averaging shuffled replicates. Phases with configural cues are still shuffled')
+    parser.add_argument("--mean-field-check", type = bool, action = argparse.BooleanOptionalAction, default = False, help = 'With --mean-field, also run the replicates of randomised phases and print the largest difference from them')
+    parser.add_argument("--batched", type = bool, action = argparse.BooleanOptionalAction, default = False, help = 'Run all the trials of randomised phases at once as a batch of arrays')
 
     parser.add_argument('--plot-phase', type = int, help = 'Plot a single phase')
     parser.add_argument("--plot-experiments", nargs = '*', help = 'List of experiments to plot. By default plot everything')
-    parser.add_argument("--plot-stimuli", nargs = '*', help = 'List of stimuli, compound and simple, to plot. By default plot everything')
+    parser.add_argument("--plot-stimuli", nargs = '*', help = 'List of stimuli, compound and simple, to plot. By default plot every simple stimulus and the compounds that appear in the experiment')
     parser.add_argument('--plot-alphas', type = bool, action = argparse.BooleanOptionalAction, help = 'Whether to plot all the alphas, including total alpha, alpha Mack, and alpha Hall.')
 
     parser.add_argument('--plot-alpha', type = bool, action = argparse.BooleanOptionalAction, help = 'Whether to plot the total alpha.')
     parser.add_argument('--plot-macknhall', type = bool, action = argparse.BooleanOptionalAction, help = 'Whether to plot the alpha Mack and alpha Hall.')
 
+    parser.add_argument('--plot-se', type = bool, action = argparse.BooleanOptionalAction, default = False, help = 'Whether to plot the standard error of randomised phases as a band around the associative strength.')
+
+    parser.add_argument('--profile', type = bool, action = argparse.BooleanOptionalAction, default = False, help = 'Time every stage of the run, per group, phase and model, count trials, replicates and allocations, and print a summary. Groups are run in this process')
+    parser.add_argument('--profile-output', type = str, help = 'Write the profile as JSON to this file. Implies --profile')
+
     parser.add_argument('--title-suffix', type = str, help = 'Title suffix')
 
     parser.add_argument('--savefig', type = str, help = 'Instead of showing figures, they will be saved to "fig_n.png"')
+    parser.add_argument('--output', type = str, help = 'Instead of plotting, write the history of every stimulus to this file. The format (.csv, .json or .npz) is given by its extension')
 
     parser.add_argument(
         "experiment_file",
@@ -73,6 +101,16 @@ def parse_args() -> argparse.Namespace:
     if args.adaptive_type.endswith('hall') and args.window_size is None:
         args.window_size = 3
 
+    if args.output is not None and os.path.splitext(args.output)[1] not in WRITERS:
+        parser.error(f'--output must end in one of {", ".join(WRITERS)}')
+
+    if args.profile_output is not None:
+        args.profile = True
+
+    if args.replicate_jobs is not None and args.replicate_jobs < 1:
+        parser.error('--replicate-jobs must be at least 1')
+    args.shard_replicates = args.replicate_jobs is not None
+
     if args.plot_alphas:
         args.plot_alpha = True
         args.plot_macknhall = True
@@ -82,9 +120,12 @@ def parse_args() -> argparse.Namespace:
 def main():
     args = parse_args()
 
+    if args.profile:
+        Profile.start()
+
     groups_strengths = None
 
-    phases: dict[str, list[Phase]] = dict()
+    groups = []
     for e, experiment in enumerate(args.experiment_file.readlines()):
         name, *phase_strs = experiment.strip().split('|')
         name = name.strip()
@@ -95,31 +136,90 @@ def main():
         if args.plot_experiments is not None and name not in args.plot_experiments:
             continue
 
-        local_strengths, local_phases = run_all_phases(name, phase_strs, args)
+        groups.append((name, phase_strs))
+
+    # Open files can't be sent to other processes.
+    run_args = argparse.Namespace(**{k: v for k, v in vars(args).items() if k != 'experiment_file'})
+
+    # Profiles of other processes would be lost.
+    executor = None
+    replicate_executor = None
+    if args.shard_replicates:
+        if args.replicate_jobs > 1 and not args.profile:
+            replicate_executor = ProcessPoolExecutor(max_workers = args.replicate_jobs)
+    elif args.jobs > 1 and not args.profile:
+        executor = ProcessPoolExecutor(max_workers = args.jobs)
+
+    cache = None
+    if args.cache_dir is not None:
+        cache = ResultCache(args.cache_dir, max_bytes = int(args.cache_size * 2**20))
+
+    phases: dict[str, list[Phase]] = dict()
+    for (name, _), (local_strengths, local_phases) in zip(groups, run_all_groups(groups, run_args, executor, cache, replicate_executor)):
         groups_strengths = [a | b for a, b in zip(groups_strengths, local_strengths)]
         phases[name] = local_phases
 
+    for x in (executor, replicate_executor):
+        if x is not None:
+            x.shutdown()
+
+    if args.se_tolerance is not None or args.sampler != 'shuffle':
+        for name, local_phases in phases.items():
+            for phase_num, phase in enumerate(local_phases, start = 1):
+                if phase.replicates is not None:
+                    print(f'{name}, phase {phase_num}: {phase.replicates} replicates, standard error at most {phase.se:.3g}', file = sys.stderr)
+
+    if args.mean_field_check:
+        for name, local_phases in phases.items():
+            for phase_num, phase in enumerate(local_phases, start = 1):
+                if phase.divergence is not None:
+                    print(f'{name}, phase {phase_num}: mean field differs from {phase.replicates} replicates by at most {phase.divergence:.3g}', file = sys.stderr)
+
+    if cache is not None and args.cache_stats:
+        print(cache.report(), file = sys.stderr)
+
     assert(groups_strengths is not None)
 
-    if args.savefig is None:
-        show_plots(
-            groups_strengths,
-            phases = phases,
-            plot_phase = args.plot_phase,
-            plot_alpha = args.plot_alpha,
-            plot_macknhall = args.plot_macknhall,
-        )
-        input('Press any key to continue...')
+    # The plotting libraries take longer to load than most simulations, so they are only
+    # imported when plotting.
+    if args.output is not None:
+        with Profile.stage('output'):
+            write_data(groups_strengths, args.output)
+    elif args.savefig is None:
+        with Profile.stage('figures'):
+            from Plots import show_plots
+
+            show_plots(
+                groups_strengths,
+                phases = phases,
+                plot_phase = args.plot_phase,
+                plot_alpha = args.plot_alpha,
+                plot_macknhall = args.plot_macknhall,
+            )
     else:
-        save_plots(
-            groups_strengths,
-            phases = phases,
-            filename = args.savefig,
-            plot_phase = args.plot_phase,
-            plot_alpha = args.plot_alpha,
-            plot_macknhall = args.plot_macknhall,
-            title_suffix = args.title_suffix
-        )
+        with Profile.stage('figures'):
+            import matplotlib
+            matplotlib.use('Agg')
+            from Plots import save_plots
+
+            save_plots(
+                groups_strengths,
+                phases = phases,
+                filename = args.savefig,
+                plot_phase = args.plot_phase,
+                plot_alpha = args.plot_alpha,
+                plot_macknhall = args.plot_macknhall,
+                title_suffix = args.title_suffix
+            )
+
+    profiler = Profile.stop()
+    if profiler is not None:
+        print(profiler.summary(), file = sys.stderr)
+        if args.profile_output is not None:
+            profiler.write(args.profile_output)
+
+    if args.output is None and args.savefig is None:
+        input('Press any key to continue...')
 
 if __name__ == '__main__':
     main()
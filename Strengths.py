@@ -3,6 +3,8 @@ from collections import deque, defaultdict
 from functools import reduce
 from itertools import combinations
 
+import numpy
+
 class Individual:
     assoc : float
 
@@ -70,21 +72,144 @@ class Individual:
     def copy(self) -> Individual:
         return Individual(**self.__dict__)
 
+# HistoryRow is a view of a single step of a History, which behaves as the Individual recorded there.
+class HistoryRow:
+    __slots__ = ('history', 'index')
+
+    def __init__(self, history : History, index : int):
+        self.history = history
+        self.index = index
+
+    def __getattr__(self, key):
+        if key == 'window':
+            return deque([])
+
+        if key not in self.history.columns:
+            raise AttributeError(key)
+
+        return float(self.history.columns[key][self.index])
+
+    def copy(self) -> Individual:
+        return Individual(**{prop: getattr(self, prop) for prop in History.FIELDS})
+
+    def __add__(self, other) -> Individual:
+        return self.copy() + other
+
+    def __truediv__(self, quot : int) -> Individual:
+        return self.copy() / quot
+
+# History records the values of a single CS at every step.
+# Values are appended to one growable array per field, and reading a field returns a NumPy view.
 class History:
-    hist : list[Individual]
+    FIELDS = ('assoc', 'Ve', 'Vi', 'alpha', 'alpha_mack', 'alpha_hall', 'delta_ma_hall')
 
-    def __init__(self):
-        self.hist = []
+    columns : dict[str, numpy.ndarray]
+    size : int
+
+    def __init__(self, capacity : int = 16):
+        self.columns = {prop: numpy.empty(capacity) for prop in self.FIELDS + ('se',)}
+        self.size = 0
+
+    @classmethod
+    def fromColumns(cls, columns : dict[str, numpy.ndarray]) -> History:
+        size = len(columns['assoc'])
+
+        ret = cls(size)
+        for prop in cls.FIELDS:
+            ret.columns[prop][:] = columns[prop]
+        ret.columns['se'][:] = columns.get('se', numpy.nan)
+        ret.size = size
+
+        return ret
+
+    # Stores the values of `ind` as Individual.copy would: Ve and Vi are reset to assoc,
+    # and falsy alpha_mack and alpha_hall are replaced by alpha.
+    # Standard error `se` of the associative strength is NaN if unknown.
+    def add(self, ind : Individual, se : None | float = None):
+        if self.size == len(self.columns['assoc']):
+            for prop, column in self.columns.items():
+                self.columns[prop] = numpy.resize(column, max(16, 2 * len(column)))
+
+        assoc = ind.assoc
+        alpha = ind.alpha
+
+        e = self.size
+        self.columns['assoc'][e] = assoc
+        self.columns['Ve'][e] = assoc
+        self.columns['Vi'][e] = assoc
+        self.columns['alpha'][e] = alpha
+        self.columns['alpha_mack'][e] = ind.alpha_mack or alpha
+        self.columns['alpha_hall'][e] = ind.alpha_hall or alpha
+        self.columns['delta_ma_hall'][e] = ind.delta_ma_hall
+        self.columns['se'][e] = numpy.nan if se is None else se
+        self.size += 1
+
+    # extend stores several steps at once. The fields in `columns` are arrays with a value for every step,
+    # and the rest are taken from `ind`; the same rules as in add apply.
+    def extend(self, ind : Individual, columns : dict[str, numpy.ndarray]):
+        size = self.size + len(columns['assoc'])
+        if size > len(self.columns['assoc']):
+            for prop, column in self.columns.items():
+                self.columns[prop] = numpy.resize(column, max(16, 2 * len(column), size))
+
+        values = {prop: columns.get(prop, getattr(ind, prop)) for prop in self.FIELDS}
+        values['Ve'] = values['assoc']
+        values['Vi'] = values['assoc']
+        for prop in ('alpha_mack', 'alpha_hall'):
+            values[prop] = numpy.where(numpy.asarray(values[prop]) != 0, values[prop], values['alpha'])
+
+        for prop, value in values.items():
+            self.columns[prop][self.size : size] = value
+        self.columns['se'][self.size : size] = numpy.nan
+        self.size = size
+
+    def __len__(self) -> int:
+        return self.size
+
+    # Returns the History of a compound of several CSs, which is the sum of their values at every step
+    # at which all of them are present. This is the same as adding their Individuals, step by step.
+    @staticmethod
+    def combine(histories : list[History]) -> History:
+        if len(histories) == 1:
+            return histories[0]
+
+        size = min(len(h) for h in histories)
+        columns = {prop: getattr(histories[0], prop)[:size] for prop in History.FIELDS}
+        for h in histories[1:]:
+            columns = {prop: x + getattr(h, prop)[:size] for prop, x in columns.items()}
+
+            # Adding Individuals replaces a falsy alpha_mack or alpha_hall by alpha.
+            for prop in ('alpha_mack', 'alpha_hall'):
+                columns[prop] = numpy.where(columns[prop] == 0, columns['alpha'], columns[prop])
+
+        columns['Ve'] = columns['assoc']
+        columns['Vi'] = columns['assoc']
+
+        return History.fromColumns(columns)
+
+    # Only the recorded steps are pickled, not the spare capacity.
+    def __getstate__(self):
+        return {'columns': {prop: column[:self.size].copy() for prop, column in self.columns.items()}, 'size': self.size}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
 
-    def add(self, ind : Individual):
-        self.hist.append(ind.copy())
+    def row(self, index : int) -> HistoryRow:
+        return HistoryRow(self, index)
+
+    @property
+    def hist(self) -> list[HistoryRow]:
+        return [self.row(e) for e in range(self.size)]
 
     def __getattr__(self, key):
-        return [getattr(p, key) for p in self.hist]
+        if key == 'columns' or key not in self.columns:
+            raise AttributeError(key)
+
+        return self.columns[key][:self.size]
 
     @classmethod
     def emptydict(cls) -> dict[str, History]:
-        return defaultdict(lambda: History())
+        return defaultdict(History)
 
 class Strengths:
     cs : set[str]
@@ -106,15 +231,16 @@ class Strengths:
         self.s = dict(s)
 
     # fromHistories "transposes" a several histories of single CSs into a single list of many CSs.
+    # Every step only holds views of the rows of the histories.
     @staticmethod
     def fromHistories(histories : dict[str, History]) -> list[Strengths]:
-        longest = max(len(x.hist) for x in histories.values())
+        longest = max(len(x) for x in histories.values())
         return [
             Strengths(
                 s = {
-                    cs: h.hist[i]
+                    cs: h.row(i)
                     for cs, h in histories.items()
-                    if len(h.hist) > i
+                    if len(h) > i
                 }
             )
             for i in range(longest)
@@ -177,3 +303,126 @@ class Strengths:
         # We use reduce rather than sum since we don't have a zero value.
         # Python reduce is the equivalent of Haskell foldl1'.
         return reduce(lambda a, b: a + b, val_quot)
+
+# Welford keeps the running mean and variance of a stream of values, which can be
+# floats or arrays of the same shape.
+class Welford:
+    n : int
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.
+        self.m2 = 0.
+
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean = self.mean + delta / self.n
+        self.m2 = self.m2 + delta * (x - self.mean)
+
+    # merge folds in the values of another Welford, as if they had been added after those of this one.
+    def merge(self, other : Welford):
+        if other.n == 0:
+            return
+
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.n / n)
+        self.m2 = self.m2 + other.m2 + delta ** 2 * (self.n * other.n / n)
+        self.n = n
+
+    def var(self):
+        if self.n < 2:
+            return 0. * self.m2
+
+        return self.m2 / (self.n - 1)
+
+    # Standard error of the mean.
+    def se(self):
+        return (self.var() / self.n) ** .5
+
+# RunningAverage folds `n` runs of a phase, one at a time, into the average History of each CS.
+# It adds `x / n` in the same order as Strengths.avg, so the result is identical, but only one
+# run needs to be in memory at any time.
+# If `n` is None, the number of runs isn't known in advance: they are added up and divided by their
+# number at the end.
+# Runs come in blocks, which are independent of each other but not necessarily within; with `blocks`, the standard
+# error of the mean assoc is computed from the means of the blocks. With `variance`, it's also kept in the result.
+class RunningAverage:
+    n : None | int
+    count : int
+    variance : bool
+    blocks : bool
+    total : dict[str, dict[str, numpy.ndarray]]
+    welford : dict[str, Welford]
+
+    # The assoc of every CS in the runs of the current block.
+    block : dict[str, list[numpy.ndarray]]
+
+    def __init__(self, n : None | int, variance : bool = False, blocks : bool = False):
+        self.n = n
+        self.count = 0
+        self.variance = variance
+        self.blocks = blocks or variance
+        self.total = {}
+        self.welford = defaultdict(Welford)
+        self.block = defaultdict(list)
+
+    # add folds in a run, which is the last of its block if `block_end`.
+    def add(self, hist : dict[str, History], block_end : bool = True):
+        for cs, h in hist.items():
+            if self.n is None:
+                quot = {prop: getattr(h, prop) for prop in History.FIELDS}
+            else:
+                quot = {prop: getattr(h, prop) / self.n for prop in History.FIELDS}
+
+            if cs in self.total:
+                self.total[cs] = {prop: self.total[cs][prop] + x for prop, x in quot.items()}
+            else:
+                self.total[cs] = quot
+
+            if self.blocks:
+                self.block[cs].append(h.assoc)
+
+        self.count += 1
+
+        if self.blocks and block_end:
+            for cs, block in self.block.items():
+                self.welford[cs].add(block[0] if len(block) == 1 else sum(block) / len(block))
+            self.block = defaultdict(list)
+
+    # merge folds in the runs of another RunningAverage of the same phase, with the same `n`, whose blocks are all complete.
+    def merge(self, other : RunningAverage):
+        for cs, columns in other.total.items():
+            if cs in self.total:
+                self.total[cs] = {prop: self.total[cs][prop] + x for prop, x in columns.items()}
+            else:
+                self.total[cs] = columns
+
+        for cs, welford in other.welford.items():
+            self.welford[cs].merge(welford)
+
+        self.count += other.count
+
+    # max_se returns the largest standard error of the mean assoc of any CS at any step, which is NaN
+    # if any of them is, and infinite until there are two blocks to estimate it from. It needs `blocks`.
+    def max_se(self) -> float:
+        assert self.blocks
+
+        if any(x.n < 2 for x in self.welford.values()):
+            return float('inf')
+
+        return max((float(numpy.max(x.se())) for x in self.welford.values()), default = 0.)
+
+    def result(self) -> dict[str, History]:
+        ret = {}
+        for cs, columns in self.total.items():
+            if self.n is None:
+                columns = {prop: x / self.count for prop, x in columns.items()}
+
+            if self.variance:
+                columns = columns | {'se': self.welford[cs].se()}
+
+            ret[cs] = History.fromColumns(columns)
+
+        return ret
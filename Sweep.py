@@ -0,0 +1,170 @@
+import argparse
+import csv
+import dataclasses
+import hashlib
+import itertools
+import json
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from Cache import code_version
+from Experiment import RWArgs, run_all_groups
+
+# Same defaults as Simulator.py.
+DEFAULTS = dict(
+    alpha = .1,
+    beta = .3,
+    beta_neg = .2,
+    lamda = 1.,
+    gamma = .5,
+    thetaE = .2,
+    thetaI = .1,
+    use_configurals = False,
+    adaptive_type = 'dualV',
+    window_size = None,
+    xi_hall = .2,
+    num_trials = 1000,
+)
+
+FIELDS = {x.name for x in dataclasses.fields(RWArgs)}
+
+def parse_value(value : str):
+    if value == 'None':
+        return None
+
+    if value in ('True', 'False'):
+        return value == 'True'
+
+    for kind in (int, float):
+        try:
+            return kind(value)
+        except ValueError:
+            pass
+
+    return value
+
+# parse_grid turns specifications of the form `name=a,b,c` or `name=start:stop:num` into a list of
+# points, one per combination of values.
+# Names are fields of RWArgs, or `alpha_X` for the alpha of a single CS X.
+def parse_grid(specs : list[str]) -> list[dict]:
+    axes = {}
+    for spec in specs:
+        match = re.fullmatch(r'([A-Za-z_]+)=(.*)', spec)
+        if match is None:
+            raise ValueError(f'Grid specification not understood: {spec}')
+
+        name, values = match.groups()
+        if name not in FIELDS and re.fullmatch(r'alpha_[A-Z]', name) is None:
+            raise ValueError(f'Unknown parameter {name}')
+
+        if (match := re.fullmatch(r'([^:]+):([^:]+):([0-9]+)', values)) is not None:
+            start, stop, num = float(match.group(1)), float(match.group(2)), int(match.group(3))
+            axes[name] = [start + (stop - start) * e / max(num - 1, 1) for e in range(num)]
+        else:
+            axes[name] = [parse_value(x) for x in values.split(',')]
+
+    return [dict(zip(axes.keys(), values)) for values in itertools.product(*axes.values())]
+
+def point_args(point : dict, seed : None | int) -> RWArgs:
+    values = DEFAULTS | {k: v for k, v in point.items() if re.fullmatch(r'alpha_[A-Z]', k) is None}
+    alphas = {k.removeprefix('alpha_'): v for k, v in point.items() if re.fullmatch(r'alpha_[A-Z]', k) is not None}
+
+    if values['window_size'] is None and values['adaptive_type'].endswith('hall'):
+        values['window_size'] = 3
+
+    return RWArgs(alphas = alphas, seed = seed, **values)
+
+# design_key identifies everything but the parameters that the rows of a point depend on: the groups, the seed
+# and the code of the model, so that checkpoints of another experiment or version are never reused.
+def design_key(groups : list[tuple[str, list[str]]], seed : None | int) -> str:
+    return hashlib.sha1(json.dumps([groups, seed, code_version()]).encode()).hexdigest()
+
+def point_key(point : dict, design : str) -> str:
+    return hashlib.sha1(json.dumps([point, design], sort_keys = True).encode()).hexdigest()[:16]
+
+# run_point runs every group of the experiment with the parameters of `point`, and writes its rows
+# to `{checkpoint}/{key}.csv`. The file is written atomically, so a point is either complete or missing.
+def run_point(point : dict, groups : list[tuple[str, list[str]]], seed : None | int, checkpoint : str, design : str) -> str:
+    key = point_key(point, design)
+    args = point_args(point, seed)
+
+    rows = []
+    for (name, _), (strengths, _) in zip(groups, run_all_groups(groups, args)):
+        for phase_num, experiments in enumerate(strengths, start = 1):
+            for series, hist in experiments.items():
+                cs = series.removeprefix(f'{name} - ')
+                for trial, (assoc, alpha) in enumerate(zip(hist.assoc, hist.alpha)):
+                    rows.append([name, phase_num, cs, trial, repr(float(assoc)), repr(float(alpha))])
+
+    path = os.path.join(checkpoint, f'{key}.csv')
+    with open(path + '.tmp', 'w', newline = '') as file:
+        csv.writer(file).writerows(rows)
+    os.replace(path + '.tmp', path)
+
+    return key
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description = 'Run an experiment across a grid of parameters',
+        epilog = 'Grid specifications are NAME=V1,V2,... or NAME=START:STOP:NUM, where NAME is a parameter such as alpha, beta, beta_neg, gamma, thetaE, thetaI, window_size or adaptive_type, or alpha_X for the alpha of CS X.',
+    )
+
+    parser.add_argument('experiment_file', type = argparse.FileType('r'), help = 'Path to the experiment file.')
+    parser.add_argument('--grid', nargs = '*', default = [], help = 'Values of each parameter; every combination is run')
+    parser.add_argument('--points', type = argparse.FileType('r'), help = 'JSON file with a list of points, each a dictionary of parameters. Combined with --grid, if both are given')
+    parser.add_argument('--checkpoint', required = True, help = 'Directory where completed points are stored. Rerunning with the same directory skips those already run with the same experiment, seed and version of the model')
+    parser.add_argument('--output', required = True, help = 'CSV file with the results of every point')
+    parser.add_argument('--seed', type = int, help = 'Seed for randomised phases')
+    parser.add_argument('--jobs', type = int, default = 1, help = 'Number of processes to run points in')
+
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    groups = []
+    for experiment in args.experiment_file.readlines():
+        if not experiment.strip():
+            continue
+
+        name, *phase_strs = experiment.strip().split('|')
+        groups.append((name.strip(), phase_strs))
+
+    points = parse_grid(args.grid)
+    if args.points is not None:
+        points = [p | q for p in json.load(args.points) for q in points]
+
+    os.makedirs(args.checkpoint, exist_ok = True)
+    done = {x.removesuffix('.csv') for x in os.listdir(args.checkpoint) if x.endswith('.csv')}
+    design = design_key(groups, args.seed)
+    todo = [p for p in points if point_key(p, design) not in done]
+    print(f'{len(points)} points, {len(points) - len(todo)} already done', file = sys.stderr)
+
+    executor = None
+    run = map
+    if args.jobs > 1:
+        executor = ProcessPoolExecutor(max_workers = args.jobs)
+        run = executor.map
+
+    completed = run(run_point, todo, itertools.repeat(groups), itertools.repeat(args.seed), itertools.repeat(args.checkpoint), itertools.repeat(design))
+    for e, _ in enumerate(completed, start = 1):
+        print(f'\r{e}/{len(todo)}', end = '', file = sys.stderr)
+    print(file = sys.stderr)
+
+    if executor is not None:
+        executor.shutdown()
+
+    names = sorted(set().union(*[p.keys() for p in points]))
+    with open(args.output, 'w', newline = '') as output:
+        writer = csv.writer(output)
+        writer.writerow(names + ['group', 'phase', 'cue', 'trial', 'assoc', 'cue_alpha'])
+        for point in points:
+            values = [point.get(k) for k in names]
+            with open(os.path.join(args.checkpoint, f'{point_key(point, design)}.csv'), newline = '') as file:
+                for row in csv.reader(file):
+                    writer.writerow(values + row)
+
+if __name__ == '__main__':
+    main()